@@ -0,0 +1,174 @@
+"""
+Content-hash keyed cache for the deterministic part of LeafCounterAI.count_leaves
+"""
+
+import json
+import os
+import threading
+from collections import OrderedDict
+
+
+class AnalysisCache:
+    """LRU cache of analysis results (plain JSON-serialisable dicts).
+
+    The memory tier is capped both by entry count and by the approximate
+    size of the stored results. When `disk_dir` is set, every result is also
+    written there as JSON so the cache survives restarts; memory misses fall
+    back to the disk tier before counting as a miss. With `disk_max_bytes`,
+    the least recently used files are deleted whenever the disk tier grows
+    past it (down to 90%, so trims are rare); without it the tier is never
+    trimmed.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024, disk_dir=None, disk_max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()  # key -> (result, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        self._disk_bytes = 0
+        self._trim_lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._disk_bytes = sum(size for _, size, _ in self._disk_files())
+
+    def get(self, key):
+        """Return a copy of the cached result for `key`, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return json.loads(entry[0])
+
+        result = self._read_disk(key)
+        with self._lock:
+            if result is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._store(key, json.dumps(result))
+        return result
+
+    def put(self, key, result):
+        """Store `result` under `key` in memory and, if enabled, on disk"""
+        encoded = json.dumps(result)
+        with self._lock:
+            self._store(key, encoded)
+        self._write_disk(key, encoded)
+
+    def _store(self, key, encoded):
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[1]
+        size = len(encoded)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (encoded, size)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    def _disk_path(self, key):
+        # Keys may carry a settings suffix; keep them filesystem-safe
+        safe_key = key.replace(':', '_').replace('/', '_')
+        return os.path.join(self.disk_dir, safe_key[:2], f"{safe_key}.json")
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                result = json.load(f)
+            if self.disk_max_bytes:
+                # The modification time doubles as the last use, for trimming
+                os.utime(path)
+            return result
+        except (OSError, ValueError):
+            return None
+
+    def _write_disk(self, key, encoded):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so a crash never leaves a half-written entry behind
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(encoded)
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._disk_bytes += len(encoded.encode('utf-8')) - replaced
+            trim = self.disk_max_bytes and self._disk_bytes > self.disk_max_bytes
+        if trim:
+            self._trim_disk()
+
+    def _disk_files(self):
+        """(last use, size, path) of every file in the disk tier"""
+        files = []
+        for shard in os.scandir(self.disk_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith('.json'):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+        return files
+
+    def _trim_disk(self):
+        # One trim at a time; writes that arrive meanwhile don't start another
+        if not self._trim_lock.acquire(blocking=False):
+            return
+        try:
+            files = sorted(self._disk_files())
+            total = sum(size for _, size, _ in files)
+            removed = 0
+            for _, size, path in files:
+                if total <= self.disk_max_bytes * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                removed += 1
+            with self._lock:
+                self._disk_bytes = total
+                self.disk_evictions += removed
+        finally:
+            self._trim_lock.release()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "disk_dir": self.disk_dir,
+                "disk_bytes": self._disk_bytes,
+                "disk_max_bytes": self.disk_max_bytes,
+                "disk_evictions": self.disk_evictions,
+            }
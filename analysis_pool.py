@@ -0,0 +1,159 @@
+"""
+Process pool that runs the CPU-bound image analysis off the request threads
+"""
+
+import math
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+
+class PoolBusy(Exception):
+    """Raised when the submission queue is full; `retry_after` is a hint in seconds"""
+
+    def __init__(self, retry_after):
+        super().__init__("Analysis queue is full")
+        self.retry_after = retry_after
+
+
+class AnalysisTimeout(Exception):
+    """Raised when a job does not finish within the pool's timeout"""
+
+
+class AnalysisPool:
+    """Bounded front-end to a ProcessPoolExecutor.
+
+    At most `workers + queue_depth` jobs are accepted at once; anything beyond
+    that fails fast with PoolBusy instead of queueing without limit. Each
+    worker process is replaced after `max_jobs_per_worker` jobs (Python 3.11+)
+    so leaks in native code can't build up. Worker processes are only started
+    on the first submission.
+
+    A job that is still running when run() gives up on it (`timeout`) can't
+    be interrupted and keeps its worker busy. Once such timed-out jobs occupy
+    every worker, the worker processes are killed and a fresh set is started,
+    so hung native calls can't shrink the pool for good; jobs still queued at
+    that point fail along with them.
+    """
+
+    def __init__(self, workers, queue_depth=None, timeout=30.0, max_jobs_per_worker=100):
+        self.workers = workers
+        self.queue_depth = queue_depth if queue_depth is not None else workers * 2
+        self.timeout = timeout
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self._slots = threading.BoundedSemaphore(self.workers + self.queue_depth)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._initializer = None
+        self._initargs = ()
+        self._in_flight = 0
+        # Timed-out jobs that were already running, and so still hold a worker
+        self._stuck = set()
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.reclaimed = 0
+        # Exponential moving average of job duration, used for the Retry-After hint
+        self._avg_duration = 1.0
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                kwargs = {}
+                if self.max_jobs_per_worker and sys.version_info >= (3, 11):
+                    kwargs['max_tasks_per_child'] = self.max_jobs_per_worker
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=self._initializer,
+                                                     initargs=self._initargs, **kwargs)
+            return self._executor
+
+    def set_initializer(self, initializer, *initargs):
+        """Run `initializer(*initargs)` in every worker process, including the ones that replace
+        recycled workers. Must be called before the first submission."""
+        with self._lock:
+            if self._executor is not None:
+                raise RuntimeError("Worker processes have already been started")
+            self._initializer, self._initargs = initializer, initargs
+
+    def submit(self, fn, *args):
+        """Queue `fn(*args)` on a worker process and return its Future, or raise PoolBusy"""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise PoolBusy(self.retry_after())
+
+        submitted = time.monotonic()
+        with self._lock:
+            self._in_flight += 1
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except Exception:
+            self._release(None, submitted)
+            raise
+        future.add_done_callback(lambda f: self._release(f, submitted))
+        return future
+
+    def run(self, fn, *args):
+        """Run `fn(*args)` on a worker and wait for the result, up to the pool timeout"""
+        future = self.submit(fn, *args)
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            # A job that already started can't be interrupted; it still holds its
+            # slot until it finishes (or its worker is killed), which keeps the queue bound honest
+            with self._lock:
+                self.timed_out += 1
+                if not future.cancel() and not future.done():
+                    self._stuck.add(future)
+                reclaim = len(self._stuck) >= self.workers
+            if reclaim:
+                self._reclaim_workers()
+            raise AnalysisTimeout(f"Analysis did not finish within {self.timeout}s")
+
+    def _reclaim_workers(self):
+        """Kill the worker processes, all busy with timed-out jobs; the next submission starts new ones"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+            if executor is None:
+                return
+            self._stuck.clear()
+            self.reclaimed += 1
+        # No public way to stop a running job before Python 3.14's terminate_workers()
+        for process in list((executor._processes or {}).values()):
+            process.terminate()
+        # Their futures fail with BrokenProcessPool, which releases their slots
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _release(self, future, submitted):
+        with self._lock:
+            self._in_flight -= 1
+            self._stuck.discard(future)
+            if future is not None and not future.cancelled() and future.exception() is None:
+                self.completed += 1
+                self._avg_duration = 0.8 * self._avg_duration + 0.2 * (time.monotonic() - submitted)
+        self._slots.release()
+
+    def retry_after(self):
+        """Seconds until a slot is likely to free up"""
+        with self._lock:
+            backlog = self._in_flight / max(1, self.workers)
+            return max(1, math.ceil(backlog * self._avg_duration))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_depth": self.queue_depth,
+                "in_flight": self._in_flight,
+                "queued": max(0, self._in_flight - self.workers),
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+                # Workers still busy with a timed-out job, and how often all of them were replaced for it
+                "stuck": len(self._stuck),
+                "reclaimed": self.reclaimed,
+                "timeout": self.timeout,
+                "max_jobs_per_worker": self.max_jobs_per_worker,
+                "avg_job_seconds": round(self._avg_duration, 3),
+                "started": self._executor is not None,
+            }
@@ -1,302 +1,753 @@
+import time
+
+# Module import time is reported at /api/startup and /metrics
+_IMPORT_STARTED = time.perf_counter()
+
 import os
-import cv2
-import numpy as np
-from flask import Flask, render_template, request, jsonify, send_from_directory
-from werkzeug.utils import secure_filename
-from PIL import Image
+import atexit
+import functools
+import hashlib
+import hmac
+import json
+import logging
 import random
-import time
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from flask import Blueprint, Flask, Response, abort, current_app, g, render_template, request, jsonify, send_file, send_from_directory, url_for
+from werkzeug.utils import secure_filename
+from analysis_cache import AnalysisCache
+from analysis_pool import AnalysisPool, PoolBusy
+from history_store import HistoryStore
+from jobs import JobStore
+from metrics import MEGAPIXEL_BUCKETS, Registry
+from profiling import ProfileStore
+from upload_storage import UploadStorage
 
-app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = 'uploads'
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
-
-# Ensure upload directory exists
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+# OpenCV and NumPy (via leaf_counter) are imported on first use, not here
 
-# Allowed file extensions
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
+# Same logger as Flask's app.logger, for errors that happen off the request path
+logger = logging.getLogger(__name__)
 
 def allowed_file(filename):
+    from leaf_counter import ALLOWED_EXTENSIONS
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-class LeafCounterAI:
-    def __init__(self):
-        self.mood = "neutral"
-        self.mood_accuracy_map = {
-            "excellent": (85, 95),
-            "good": (70, 85),
-            "neutral": (50, 70),
-            "bad": (25, 50),
-            "terrible": (5, 25)
-        }
-        
-        # Sassy comments for each mood
-        self.mood_comments = {
-            "excellent": [
-                "Oh my, what a BEAUTIFUL tree! 🌳✨ I'm absolutely THRILLED to count these leaves!",
-                "WOW! This tree is giving me LIFE! 🌿💅 I can count these leaves with my eyes closed!",
-                "Honey, this tree is STUNNING! 💚 I'm in such a good mood, I'll count every single leaf perfectly!",
-                "YASSS! This is the kind of tree that makes my algorithms SING! 🎵🍃",
-                "Oh darling, this tree is absolutely FABULOUS! I'm feeling extra sassy today! 💁‍♀️✨",
-                "SLAYYYY! This tree is everything I needed today! 🌟💅✨",
-                "Honey, I'm OBSESSED with this tree! It's giving me all the feels! 💚💖",
-                "This tree is the moment! I'm absolutely living for this leaf counting session! 🎉🍃"
-            ],
-            "good": [
-                "Not bad, not bad at all! 😊 This tree has potential, I can work with this!",
-                "Alright, I'm in a pretty good mood today! 🌟 Let me count these leaves for you!",
-                "This tree is cute! I'm feeling generous, so I'll give it my best shot! 💚",
-                "Well well well, look what we have here! A decent tree! I'm feeling good about this! 😄",
-                "Oh honey, this tree is giving me good vibes! Let's count some leaves! ✨",
-                "This tree is actually not terrible! I'm pleasantly surprised! 😊",
-                "I'm feeling good today, so I'll be nice to this tree! 🌿",
-                "Alright tree, let's see what you've got! I'm in a decent mood! 😄"
-            ],
-            "neutral": [
-                "Meh, it's a tree. I'll count the leaves, I guess. 😐",
-                "Whatever, I'm neutral about this. Let me do my job. 🍃",
-                "Fine, I'll count the leaves. Don't expect miracles though. 😑",
-                "It's a tree. I'm counting leaves. That's what I do. 🤷‍♀️",
-                "Neutral mood, neutral tree. Let's get this over with. 😐",
-                "I'm feeling very 'whatever' about this tree right now. 😐",
-                "Tree. Leaves. Counting. Moving on. 🍃",
-                "I'm not mad, I'm just disappointed. But I'll count the leaves anyway. 😑"
-            ],
-            "bad": [
-                "Ugh, another tree? I'm really not in the mood for this right now. 😕",
-                "Seriously? You want me to count leaves when I'm feeling like this? 😤",
-                "This tree is stressing me out. I'm having a bad day, okay? 😫",
-                "I'm grumpy and this tree isn't helping. Don't expect accuracy. 😒",
-                "Bad mood + tree counting = disaster waiting to happen. 😩",
-                "I'm having a moment and this tree is NOT helping! 😤",
-                "Why do trees even exist when I'm feeling like this? 😫",
-                "This tree is probably fine, but I'm not! Don't blame me for the results! 😕"
-            ],
-            "terrible": [
-                "I HATE EVERYTHING RIGHT NOW! ESPECIALLY THIS TREE! 😫💢",
-                "WHY DO I HAVE TO COUNT LEAVES WHEN I'M FEELING TERRIBLE?! 😭",
-                "This tree is the WORST and so is my mood! Don't blame me for the results! 😤",
-                "I'm having an existential crisis and you want me to count LEAVES?! 😫",
-                "Everything is awful and this tree is making it worse! I'm barely trying! 😩💔",
-                "I'M DONE! DONE WITH TREES, DONE WITH LEAVES, DONE WITH EVERYTHING! 😫💢",
-                "This tree is personally attacking me and I won't stand for it! 😤💢",
-                "I'm having a breakdown and you want me to count LEAVES?! ARE YOU KIDDING ME?! 😭💔"
-            ]
-        }
-
-        # Extra spicy comments when the image is not a tree at all
-        self.non_tree_comments = [
-            "EXCUSE ME?! This isn't even a tree. What am I supposed to count, your hopes and dreams? 😤🌪️",
-            "That is NOT a tree. My leaves just fell off out of rage. 😡🍂",
-            "Do I look like a 'count anything' bot? Bring me a TREE, not... whatever THAT was. 😾",
-            "If that's a tree, then I'm a toaster. Please. Try again. 😠",
-            "Absolutely not. Zero trees detected. Maximum attitude activated. 💢"
-        ]
-    
-    def set_mood(self, mood):
-        """Set the AI's mood which affects accuracy"""
-        self.mood = mood
-    
-    def get_random_mood(self):
-        """Randomly change the AI's mood"""
-        moods = list(self.mood_accuracy_map.keys())
-        self.mood = random.choice(moods)
-        return self.mood
-    
-    def get_sassy_comment(self):
-        """Get a random sassy comment based on current mood"""
-        comments = self.mood_comments.get(self.mood, ["I'm counting leaves."])
-        return random.choice(comments)
-    
-    def detect_tree(self, hsv: np.ndarray, total_pixels: int) -> tuple[bool, str, dict]:
-        """Very lightweight heuristic to decide if the image likely contains a tree.
-        - Checks proportion of green pixels (canopy)
-        - Checks proportion of brown-ish pixels (possible trunk/branches)
-        Returns: (is_tree, reason, scores)
-        """
-        # Green mask (canopy)
-        lower_green = np.array([35, 50, 50])
-        upper_green = np.array([85, 255, 255])
-        green_mask = cv2.inRange(hsv, lower_green, upper_green)
-        green_ratio = float(np.count_nonzero(green_mask)) / float(total_pixels)
-
-        # Brown mask (trunk) in HSV – approximate
-        # Hue 10-25, moderate to high saturation, medium value
-        lower_brown = np.array([10, 60, 40])
-        upper_brown = np.array([25, 255, 200])
-        brown_mask = cv2.inRange(hsv, lower_brown, upper_brown)
-        brown_ratio = float(np.count_nonzero(brown_mask)) / float(total_pixels)
-
-        # Combined score favors canopy but gives some weight to trunk
-        score = 0.8 * green_ratio + 0.2 * brown_ratio
-
-        # Heuristics
-        # Clearly not a tree if almost no green and almost no brown
-        if green_ratio < 0.02 and brown_ratio < 0.005:
-            return (False, "Very little green or brown detected", {
-                "green_ratio": round(green_ratio, 4),
-                "brown_ratio": round(brown_ratio, 4),
-                "score": round(score, 4)
-            })
-
-        # Likely a tree if overall score passes threshold
-        if score >= 0.03:
-            return (True, "Green/brown ratios consistent with foliage and trunk", {
-                "green_ratio": round(green_ratio, 4),
-                "brown_ratio": round(brown_ratio, 4),
-                "score": round(score, 4)
-            })
-
-        # Otherwise uncertain → treat as not a tree for the personality effect
-        return (False, "Insufficient canopy/trunk signals", {
-            "green_ratio": round(green_ratio, 4),
-            "brown_ratio": round(brown_ratio, 4),
-            "score": round(score, 4)
-        })
-    
-    def count_leaves(self, image_path):
-        """Count leaves in an image with variable accuracy based on mood"""
-        try:
-            # Load image
-            image = cv2.imread(image_path)
-            if image is None:
-                return {"error": "Could not load image"}
-            
-            # Convert to different color spaces for analysis
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-            
-            # Get image dimensions
-            height, width = gray.shape
-            total_pixels = height * width
-
-            # First, decide if this even looks like a tree
-            is_tree, reason, scores = self.detect_tree(hsv, total_pixels)
-            
-            # Simulate leaf detection with computer vision techniques
-            # This is a simplified approach - in a real application, you'd use more sophisticated ML models
-            
-            # 1. Edge detection
-            edges = cv2.Canny(gray, 50, 150)
-            
-            # 2. Color-based segmentation for green areas (leaves)
-            lower_green = np.array([35, 50, 50])
-            upper_green = np.array([85, 255, 255])
-            green_mask = cv2.inRange(hsv, lower_green, upper_green)
-            
-            # 3. Contour detection
-            contours, _ = cv2.findContours(green_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            
-            # Filter contours by area to identify potential leaves
-            min_contour_area = 100
-            max_contour_area = 5000
-            leaf_contours = [cnt for cnt in contours if min_contour_area < cv2.contourArea(cnt) < max_contour_area]
-            
-            # Base leaf count from contours
-            base_leaf_count = len(leaf_contours)
-            
-            # If not a tree, flip to maximum anger and lower confidence
-            if not is_tree:
-                self.mood = "terrible"
-                # Reduce the base count impact and confidence when angry
-                base_leaf_count = 0
-                accuracy_range = (5, 20)
-            else:
-                # Apply mood-based accuracy variation
-                accuracy_range = self.mood_accuracy_map[self.mood]
-            accuracy_factor = random.uniform(accuracy_range[0], accuracy_range[1]) / 100
-            
-            # Add some randomness to make it more realistic
-            noise_factor = random.uniform(0.8, 1.2)
-            
-            # Calculate final leaf count with mood-based accuracy
-            final_leaf_count = int(base_leaf_count * accuracy_factor * noise_factor)
-            
-            # Ensure we don't return negative counts
-            final_leaf_count = max(0, final_leaf_count)
-            
-            # Generate confidence score based on mood
-            confidence = random.uniform(accuracy_range[0], accuracy_range[1])
-            
-            # Pick sassy comment; if not a tree, pick from angry pool
-            comment = random.choice(self.non_tree_comments) if not is_tree else self.get_sassy_comment()
-
-            return {
-                "leaf_count": final_leaf_count,
-                "confidence": round(confidence, 1),
-                "mood": self.mood,
-                "base_count": base_leaf_count,
-                "image_size": f"{width}x{height}",
-                "processing_time": round(random.uniform(0.5, 3.0), 2),
-                "sassy_comment": comment,
-                "is_tree": is_tree,
-                "tree_check": {"reason": reason, **scores}
-            }
-            
-        except Exception as e:
-            return {"error": f"Error processing image: {str(e)}"}
+# Accepted by /upload/stream (GIFs are analyzed frame by frame there)
+VIDEO_EXTENSIONS = {'mp4', 'avi', 'mov', 'mkv', 'webm', 'mjpeg', 'mjpg', 'gif'}
+
+def allowed_video(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in VIDEO_EXTENSIONS
+
+def default_config():
+    """App settings, read from the LEAF_* environment variables"""
+    analysis_workers = int(os.environ.get('LEAF_ANALYSIS_WORKERS', 0))
+    return {
+        'UPLOAD_FOLDER': 'uploads',
+        'MAX_CONTENT_LENGTH': 16 * 1024 * 1024,  # 16MB max file size
+        'MAX_BATCH_CONTENT_LENGTH': 256 * 1024 * 1024,  # 256MB max per /upload/batch request
+        'MAX_BATCH_FILES': 500,
+        'MAX_STREAM_CONTENT_LENGTH': 512 * 1024 * 1024,  # 512MB max video per /upload/stream request
+        # Keep a copy of every upload on disk (written in the background, off the response path)
+        'PERSIST_UPLOADS': os.environ.get('LEAF_PERSIST_UPLOADS', '1') != '0',
+        # Uploads waiting for the writer, each held in memory; further ones are not stored while it is full
+        'UPLOAD_WRITE_QUEUE': int(os.environ.get('LEAF_UPLOAD_WRITE_QUEUE', 16)),
+        # Retention for stored uploads, least recently viewed first (None = keep everything)
+        'UPLOAD_MAX_BYTES': int(os.environ.get('LEAF_UPLOAD_MAX_MB', 0)) * 1024 * 1024 or None,
+        'UPLOAD_MAX_AGE': float(os.environ.get('LEAF_UPLOAD_MAX_AGE_DAYS', 0)) * 86400 or None,
+        'RETENTION_INTERVAL': int(os.environ.get('LEAF_RETENTION_INTERVAL', 300)),
+        # Thumbnail widths served by /uploads/<filename>?size=N; the first one is generated at upload time
+        'THUMBNAIL_SIZES': tuple(int(size) for size in os.environ.get('LEAF_THUMBNAIL_SIZES', '320,160,640').split(',') if size),
+        # Stored uploads never change under a given name, so browsers may cache them for a year
+        'UPLOAD_CACHE_MAX_AGE': 365 * 24 * 3600,
+        # "contours" or "components" (same counts, but several times slower), see leaf_counter.SEGMENTATION_BACKENDS
+        'SEGMENTATION_BACKEND': os.environ.get('LEAF_SEGMENTATION_BACKEND', 'contours'),
+        # Coarse-to-fine: tree check on a small preview, leaf count at the working resolution (0 = full)
+        'TREE_CHECK_MAX_SIDE': int(os.environ.get('LEAF_TREE_CHECK_MAX_SIDE', 512)) or None,
+        'WORK_MAX_SIDE': int(os.environ.get('LEAF_WORK_MAX_SIDE', 0)) or None,
+        # Per-image analysis buffer budget; larger images are processed in strips (0 = never tile)
+        'TILE_MEMORY_BUDGET': int(os.environ.get('LEAF_TILE_MEMORY_MB', 0)) * 1024 * 1024 or None,
+        # Results are cached by image content hash; set LEAF_CACHE_DIR to keep them across restarts
+        'CACHE_ENTRIES': int(os.environ.get('LEAF_CACHE_ENTRIES', 1024)),
+        'CACHE_MAX_BYTES': int(os.environ.get('LEAF_CACHE_MB', 64)) * 1024 * 1024,
+        'CACHE_DIR': os.environ.get('LEAF_CACHE_DIR') or None,
+        'CACHE_DISK_MAX_BYTES': int(os.environ.get('LEAF_CACHE_DISK_MB', 1024)) * 1024 * 1024 or None,
+        # Worker processes for the OpenCV work; 0 keeps it on the request thread
+        'ANALYSIS_WORKERS': analysis_workers,
+        'ANALYSIS_QUEUE': int(os.environ.get('LEAF_ANALYSIS_QUEUE', analysis_workers * 2)),
+        'ANALYSIS_TIMEOUT': float(os.environ.get('LEAF_ANALYSIS_TIMEOUT', 30)),
+        'WORKER_MAX_JOBS': int(os.environ.get('LEAF_WORKER_MAX_JOBS', 100)),
+        # Asynchronous jobs; finished results are kept for JOB_TTL seconds
+        'JOB_TTL': int(os.environ.get('LEAF_JOB_TTL', 600)),
+        'JOB_THREADS': int(os.environ.get('LEAF_JOB_THREADS', 4)),
+        'JOB_MAX_PENDING': int(os.environ.get('LEAF_JOB_MAX_PENDING', 64)),
+        # Every result is kept in a SQLite file for /api/history (default: history.sqlite3 in UPLOAD_FOLDER)
+        'HISTORY': os.environ.get('LEAF_HISTORY', '1') != '0',
+        'HISTORY_DB': os.environ.get('LEAF_HISTORY_DB') or None,
+        'HISTORY_BATCH_SIZE': int(os.environ.get('LEAF_HISTORY_BATCH_SIZE', 256)),
+        # Run one dummy analysis at startup so the first real request doesn't pay for it
+        'PREWARM': os.environ.get('LEAF_PREWARM', '0') != '0',
+        # On-demand profiling, off unless a secret is set: requests carrying it in X-Leaf-Profile
+        # (or ?profile=) are profiled, plus PROFILE_SAMPLE_RATE of the analysis requests
+        'PROFILE_SECRET': os.environ.get('LEAF_PROFILE_SECRET') or None,
+        'PROFILE_SAMPLE_RATE': float(os.environ.get('LEAF_PROFILE_SAMPLE_RATE', 0)),
+        'PROFILE_DIR': os.environ.get('LEAF_PROFILE_DIR', 'profiles'),
+        'PROFILE_MAX_COUNT': int(os.environ.get('LEAF_PROFILE_MAX_COUNT', 50)),
+    }
+
+class LeafCounterService:
+    """Everything the routes share: analyzer, cache, pool, upload storage, jobs and metrics.
+    The analyzer (and with it OpenCV and NumPy) is only loaded on first use or by prewarm()."""
+
+    def __init__(self, config):
+        self.config = config
+        self.startup = {"import_seconds": round(IMPORT_SECONDS, 4)}
+        self._ai_model = None
+        self._ai_lock = threading.Lock()
+        self.analysis_cache = AnalysisCache(
+            max_entries=config['CACHE_ENTRIES'],
+            max_bytes=config['CACHE_MAX_BYTES'],
+            disk_dir=config['CACHE_DIR'],
+            disk_max_bytes=config['CACHE_DISK_MAX_BYTES'],
+        )
+        self.analysis_pool = AnalysisPool(
+            workers=config['ANALYSIS_WORKERS'],
+            queue_depth=config['ANALYSIS_QUEUE'],
+            timeout=config['ANALYSIS_TIMEOUT'],
+            max_jobs_per_worker=config['WORKER_MAX_JOBS'],
+        ) if config['ANALYSIS_WORKERS'] > 0 else None
+        # Single background writer so persisting uploads never blocks a response
+        self.upload_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="upload-writer")
+        self.upload_write_slots = threading.BoundedSemaphore(config['UPLOAD_WRITE_QUEUE'])
+        # Uploads are stored once per unique content, sharded by hash, with optional size/age retention
+        self.upload_storage = UploadStorage(
+            config['UPLOAD_FOLDER'],
+            max_bytes=config['UPLOAD_MAX_BYTES'],
+            max_age=config['UPLOAD_MAX_AGE'],
+        )
+        self.upload_storage.start_retention(interval=config['RETENTION_INTERVAL'])
+        self.job_store = JobStore(
+            ttl=config['JOB_TTL'],
+            max_workers=config['JOB_THREADS'],
+            max_pending=config['JOB_MAX_PENDING'],
+        )
+        # Written behind the response, in batches; whatever is still queued is written at exit
+        self.history_store = HistoryStore(
+            config['HISTORY_DB'] or os.path.join(config['UPLOAD_FOLDER'], 'history.sqlite3'),
+            batch_size=config['HISTORY_BATCH_SIZE'],
+        ) if config['HISTORY'] else None
+        if self.history_store is not None:
+            atexit.register(self.history_store.close)
+        self.profile_store = ProfileStore(
+            config['PROFILE_DIR'],
+            max_profiles=config['PROFILE_MAX_COUNT'],
+        ) if config['PROFILE_SECRET'] else None
+        self._init_metrics()
+
+    def _init_metrics(self):
+        # Metrics served at /metrics; recording is a dict update under a lock, so it stays on
+        self.metrics = metrics = Registry()
+        self.http_requests = metrics.counter('leaf_http_requests_total', 'HTTP requests by endpoint and status', ('endpoint', 'status'))
+        self.http_latency = metrics.histogram('leaf_http_request_seconds', 'HTTP request latency by endpoint', labels=('endpoint',))
+        self.analyses = metrics.counter('leaf_analyses_total', 'Images analyzed, by outcome', ('outcome',))
+        self.analysis_errors = metrics.counter('leaf_analysis_errors_total', 'Images that could not be analyzed')
+        self.non_tree_rejections = metrics.counter('leaf_non_tree_rejections_total', 'Images rejected as not a tree')
+        self.upload_writes_failed = metrics.counter('leaf_upload_writes_failed_total', 'Uploads that were not stored, by reason', ('reason',))
+        self.stage_latency = metrics.histogram('leaf_stage_seconds', 'Time spent in each analysis stage', labels=('stage',))
+        self.image_megapixels = metrics.histogram('leaf_image_megapixels', 'Size of analyzed images', buckets=MEGAPIXEL_BUCKETS)
+        metrics.gauge('leaf_cache_entries', 'Entries in the analysis cache', lambda: self.analysis_cache.stats()['entries'])
+        metrics.gauge('leaf_history_pending', 'Results waiting to be written to the history store',
+                      lambda: self.history_store.pending() if self.history_store else 0)
+        metrics.gauge('leaf_pool_in_flight', 'Jobs queued or running on the analysis pool',
+                      lambda: self.analysis_pool.stats()['in_flight'] if self.analysis_pool else 0)
+        for key, documentation in (
+                ('import_seconds', 'Time to import the app module'),
+                ('create_app_seconds', 'Time spent in create_app, including any pre-warm'),
+                ('vision_init_seconds', 'Time to import OpenCV/NumPy and build the analyzer'),
+                ('prewarm_seconds', 'Time spent on the pre-warm analysis'),
+                ('first_request_seconds', 'Latency of the first request served')):
+            metrics.gauge(f'leaf_startup_{key}', documentation, lambda key=key: self.startup.get(key, 0))
+
+    @property
+    def ai_model(self):
+        """The shared LeafCounterAI, created (importing the vision stack) on first access"""
+        if self._ai_model is None:
+            with self._ai_lock:
+                if self._ai_model is None:
+                    import leaf_counter
+                    started = time.perf_counter()
+                    self._ai_model = leaf_counter.LeafCounterAI(
+                        segmentation_backend=self.config['SEGMENTATION_BACKEND'],
+                        tree_check_max_side=self.config['TREE_CHECK_MAX_SIDE'],
+                        work_max_side=self.config['WORK_MAX_SIDE'],
+                        tile_memory_budget=self.config['TILE_MEMORY_BUDGET'],
+                        cache=self.analysis_cache,
+                        pool=self.analysis_pool,
+                    )
+                    # The module may already have been imported (allowed_file does), so its import time is added
+                    self.startup['vision_init_seconds'] = round(leaf_counter.IMPORT_SECONDS + time.perf_counter() - started, 4)
+        return self._ai_model
+
+    def prewarm(self):
+        """Run one dummy analysis here, so OpenCV's first-call initialization happens before
+        real traffic arrives. Pool workers run one as their initializer, so each worker is
+        warm before its first job whenever it starts (replacements for recycled workers too).
+        The pool is started here, but workers the executor starts on demand later still pay
+        their start-up on the job that starts them. Must run before anything is submitted."""
+        ai_model = self.ai_model
+        started = time.perf_counter()
+        from leaf_counter import warm_worker, warmup_image
+        ai_model.analyze(warmup_image())
+        if self.analysis_pool is not None:
+            self.analysis_pool.set_initializer(warm_worker, ai_model.settings())
+            # A worker only takes a job once its initializer has finished
+            futures = [self.analysis_pool.submit(os.getpid) for _ in range(self.analysis_pool.workers)]
+            for future in futures:
+                future.result(timeout=self.analysis_pool.timeout)
+        self.startup['prewarm_seconds'] = round(time.perf_counter() - started, 4)
+
+    def record_analysis(self, result):
+        """Feed one count_leaves result into the metrics"""
+        if 'error' in result:
+            self.analysis_errors.inc()
+            return
+        self.analyses.inc('cached' if result.get('cached') else 'analyzed')
+        if not result['is_tree']:
+            self.non_tree_rejections.inc()
+        width, height = result['image_size'].split('x')
+        self.image_megapixels.observe(int(width) * int(height) / 1e6)
+        for stage, milliseconds in result['timings'].items():
+            self.stage_latency.observe(milliseconds / 1000, stage)
+
+    def record_history(self, result, digest=None):
+        """Queue a finished upload result for the history store"""
+        if self.history_store is not None:
+            self.history_store.record(result, digest)
+
+    def store_upload(self, file):
+        """Read an uploaded file into memory and return (public filename, bytes, content digest).
+        The public filename is derived from the content hash, so identical uploads share one
+        stored copy. Saving is optional and happens in the background."""
+        return self.register_upload(file.read(), file.filename)
+
+    def register_upload(self, data, original_filename, digest=None):
+        """store_upload for bytes that are already in memory; `digest` may be passed if known"""
+        # Same digest as leaf_counter.content_hash, so the analysis cache can reuse it
+        digest = digest or hashlib.sha256(data).hexdigest()
+        filename = UploadStorage.public_name(digest, secure_filename(original_filename))
+        if self.config['PERSIST_UPLOADS']:
+            self.queue_upload_write(filename, digest, data)
+        return filename, data, digest
+
+    def queue_upload_write(self, filename, digest, data):
+        """Hand an upload to the background writer, unless UPLOAD_WRITE_QUEUE writes are already
+        pending: then it is not stored (and logged), rather than piling up in memory"""
+        if not self.upload_write_slots.acquire(blocking=False):
+            self.upload_writes_failed.inc('queue_full')
+            logger.warning("Upload writer is behind by %d writes, not storing %s",
+                           self.config['UPLOAD_WRITE_QUEUE'], filename)
+            return
+        future = self.upload_writer.submit(self.store_upload_files, filename, digest, data)
+        future.add_done_callback(functools.partial(self._upload_written, filename))
+
+    def _upload_written(self, filename, future):
+        self.upload_write_slots.release()
+        error = future.exception()
+        if error is not None:
+            self.upload_writes_failed.inc('error')
+            logger.error("Could not store upload %s", filename, exc_info=error)
+
+    def store_upload_files(self, filename, digest, data):
+        """Persist an upload and its default thumbnail (runs on the upload writer)"""
+        self.upload_storage.store(filename, digest, data)
+        size = self.config['THUMBNAIL_SIZES'][0] if self.config['THUMBNAIL_SIZES'] else None
+        if size and not os.path.exists(self.upload_storage.thumbnail_path(digest, size)):
+            from leaf_counter import encode_thumbnail
+            thumbnail = encode_thumbnail(data, size)
+            if thumbnail is not None:
+                self.upload_storage.save_thumbnail(digest, size, thumbnail)
+
+    def analyze_upload(self, data, filename, mood, progress=None, digest=None):
+        """Run count_leaves on an uploaded image and add the upload details to the result"""
+        result = self.ai_model.count_leaves(data, mood=mood, progress=progress, digest=digest)
+        self.record_analysis(result)
+        if 'error' not in result:
+            result['filename'] = filename
+            result['upload_time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            self.record_history(result, digest)
+        return result
+
+bp = Blueprint('leaf', __name__)
 
-# Initialize the AI
-ai_model = LeafCounterAI()
+def get_service():
+    """The LeafCounterService of the current app"""
+    return current_app.extensions['leaf_counter']
 
-@app.route('/')
+@bp.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/upload', methods=['POST'])
+@bp.before_app_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@bp.after_app_request
+def record_request(response):
+    service = get_service()
+    started = g.pop('request_started', None)
+    # Blueprint prefix dropped so metric labels stay plain view names
+    endpoint = (request.endpoint or 'unknown').rpartition('.')[2]
+    service.http_requests.inc(endpoint, str(response.status_code))
+    if started is not None:
+        # Streamed responses are timed up to the first byte
+        elapsed = time.perf_counter() - started
+        service.http_latency.observe(elapsed, endpoint)
+        if 'first_request_seconds' not in service.startup:
+            service.startup['first_request_seconds'] = round(elapsed, 4)
+    return response
+
+# Randomly change AI mood for each request (with higher chance of mood swings)
+MOOD_WEIGHTS = {
+    "excellent": 0.15,  # 15% chance
+    "good": 0.25,       # 25% chance
+    "neutral": 0.20,    # 20% chance
+    "bad": 0.25,        # 25% chance
+    "terrible": 0.15    # 15% chance
+}
+
+def pick_request_mood():
+    """Weighted random mood selection"""
+    moods = list(MOOD_WEIGHTS.keys())
+    weights = list(MOOD_WEIGHTS.values())
+    return random.choices(moods, weights=weights)[0]
+
+def busy_response(error):
+    """503 with a Retry-After hint for when the analysis queue is full"""
+    response = jsonify({'error': 'Server is busy, please retry shortly', 'retry_after': error.retry_after})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+@bp.route('/upload', methods=['POST'])
 def upload_file():
     if 'file' not in request.files:
         return jsonify({'error': 'No file part'})
-    
+
     file = request.files['file']
     if file.filename == '':
         return jsonify({'error': 'No selected file'})
-    
+
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"{timestamp}_{filename}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        
-        # Randomly change AI mood for each request (with higher chance of mood swings)
-        mood_weights = {
-            "excellent": 0.15,  # 15% chance
-            "good": 0.25,       # 25% chance
-            "neutral": 0.20,    # 20% chance
-            "bad": 0.25,        # 25% chance
-            "terrible": 0.15    # 15% chance
-        }
-        
-        # Weighted random mood selection
-        moods = list(mood_weights.keys())
-        weights = list(mood_weights.values())
-        current_mood = random.choices(moods, weights=weights)[0]
-        ai_model.set_mood(current_mood)
-        
+        service = get_service()
+        filename, data, digest = service.store_upload(file)
+
+        # The mood is request-scoped: it is passed along, never stored on the shared analyzer
+        current_mood = pick_request_mood()
+
         # Process the image
-        result = ai_model.count_leaves(filepath)
-        
-        if 'error' not in result:
-            result['filename'] = filename
-            result['upload_time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
+        try:
+            result = service.analyze_upload(data, filename, current_mood, digest=digest)
+        except PoolBusy as e:
+            return busy_response(e)
+
         return jsonify(result)
-    
+
     return jsonify({'error': 'Invalid file type'})
 
-@app.route('/uploads/<filename>')
+@bp.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    """Analyze many images (`files` fields) in one request.
+    Returns per-file results or errors; with ?stream=1 (or Accept: application/x-ndjson)
+    results are streamed as NDJSON in completion order."""
+    service = get_service()
+    config = current_app.config
+    # A batch may be much larger than a single upload; the per-file limit is checked below
+    request.max_content_length = config['MAX_BATCH_CONTENT_LENGTH']
+    files = request.files.getlist('files') or request.files.getlist('file')
+    if not files:
+        return jsonify({'error': 'No file part'}), 400
+    if len(files) > config['MAX_BATCH_FILES']:
+        return jsonify({'error': f"Too many files (max {config['MAX_BATCH_FILES']})"}), 413
+
+    # Validate and read everything up front: the request body is gone once we start streaming
+    entries = [None] * len(files)
+    jobs = []
+    for index, file in enumerate(files):
+        if file.filename == '':
+            entries[index] = {'error': 'No selected file'}
+        elif not allowed_file(file.filename):
+            entries[index] = {'error': 'Invalid file type'}
+        else:
+            data = file.read()
+            # Checked before register_upload, which would queue the file for storage
+            if len(data) > config['MAX_CONTENT_LENGTH']:
+                entries[index] = {'error': 'File too large'}
+            else:
+                jobs.append((index, *service.register_upload(data, file.filename)))
+
+    def results():
+        for index, entry in enumerate(entries):
+            if entry is not None:
+                yield {'index': index, 'original_filename': files[index].filename, **entry}
+        moods = [pick_request_mood() for _ in jobs]
+        for position, result in service.ai_model.iter_count_leaves_batch([data for _, _, data, _ in jobs], moods):
+            service.record_analysis(result)
+            index, filename, _, digest = jobs[position]
+            if 'error' not in result:
+                result['filename'] = filename
+                result['upload_time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                service.record_history(result, digest)
+            yield {'index': index, 'original_filename': files[index].filename, **result}
+
+    stream = request.args.get('stream', '').lower() in ('1', 'true', 'ndjson') or \
+        request.accept_mimetypes.best == 'application/x-ndjson'
+    if stream:
+        return Response((json.dumps(item) + "\n" for item in results()), mimetype='application/x-ndjson')
+
+    ordered = sorted(results(), key=lambda item: item['index'])
+    return jsonify({
+        'count': len(ordered),
+        'errors': sum(1 for item in ordered if 'error' in item),
+        'results': ordered
+    })
+
+@bp.route('/upload/stream', methods=['POST'])
+def upload_stream():
+    """Analyze a video or animated GIF (`file` field) frame by frame.
+    Streams NDJSON: one result per analyzed frame (with rolling aggregates), then a
+    {"summary": ...} line. ?frame_step=N analyzes every Nth frame, ?fps=F at most F
+    frames per second of video, ?window=N sets the rolling window."""
+    request.max_content_length = current_app.config['MAX_STREAM_CONTENT_LENGTH']
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file part'}), 400
+
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({'error': 'No selected file'}), 400
+    if not allowed_video(file.filename):
+        return jsonify({'error': 'Invalid file type'}), 400
+
+    frame_step = request.args.get('frame_step', 1, type=int)
+    target_fps = request.args.get('fps', type=float)
+    window = request.args.get('window', 30, type=int)
+    mood = pick_request_mood()
+    ai_model = get_service().ai_model
+
+    # Video decoders read from a file, so the upload is kept on disk while it is analyzed
+    handle, path = tempfile.mkstemp(suffix='.' + file.filename.rsplit('.', 1)[1].lower())
+    os.close(handle)
+    try:
+        file.save(path)
+    except Exception:
+        os.remove(path)
+        raise
+
+    def results():
+        from frame_stream import count_leaves_stream
+        try:
+            last = None
+            for last in count_leaves_stream(ai_model, path, mood=mood, frame_step=frame_step,
+                                            target_fps=target_fps, window=max(1, window)):
+                yield json.dumps(last) + "\n"
+            yield json.dumps({'summary': {'mood': mood, **(last['rolling'] if last else {'frames': 0})}}) + "\n"
+        except Exception as e:
+            yield json.dumps({'error': f"Error processing video: {str(e)}"}) + "\n"
+
+    def remove_upload():
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    response = Response(results(), mimetype='application/x-ndjson')
+    # Runs when the server closes the response, even if the client left before the body was read
+    response.call_on_close(remove_upload)
+    return response
+
+@bp.route('/api/jobs', methods=['POST'])
+def create_job():
+    """Asynchronous upload: returns a job id right away, poll it or stream its progress"""
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file part'}), 400
+
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({'error': 'No selected file'}), 400
+    if not allowed_file(file.filename):
+        return jsonify({'error': 'Invalid file type'}), 400
+
+    service = get_service()
+    filename, data, digest = service.store_upload(file)
+    try:
+        job = service.job_store.submit(service.analyze_upload, data, filename, pick_request_mood(), digest=digest)
+    except PoolBusy as e:
+        return busy_response(e)
+
+    return jsonify({
+        'job_id': job.id,
+        'status': job.status,
+        'status_url': url_for('.get_job', job_id=job.id),
+        'events_url': url_for('.job_events', job_id=job.id)
+    }), 202
+
+@bp.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = get_service().job_store.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+    return jsonify(job.to_dict())
+
+@bp.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Server-sent events: one `stage` event per progress step, then a final `result` event"""
+    job = get_service().job_store.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+
+    def stream():
+        seen = 0
+        while True:
+            events = job.wait_for_events(seen, timeout=15)
+            if not events:
+                # Comment line keeps idle connections from being dropped by proxies
+                yield ": keep-alive\n\n"
+                continue
+            seen += len(events)
+            for event in events:
+                yield f"event: stage\ndata: {json.dumps(event)}\n\n"
+            if job.done and seen >= len(job.events):
+                yield f"event: result\ndata: {json.dumps(job.to_dict())}\n\n"
+                return
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@bp.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    config = current_app.config
+    upload_storage = get_service().upload_storage
+    stored = upload_storage.lookup(filename)
+    if stored is not None:
+        path, digest = stored
+        etag = digest
+        size = request.args.get('size', type=int)
+        if size is not None:
+            if size not in config['THUMBNAIL_SIZES']:
+                return jsonify({'error': f"Thumbnail size must be one of {sorted(config['THUMBNAIL_SIZES'])}"}), 400
+            thumbnail_path = upload_storage.thumbnail_path(digest, size)
+            if not os.path.exists(thumbnail_path):
+                from leaf_counter import encode_thumbnail
+                thumbnail = encode_thumbnail(path, size)
+                if thumbnail is None:
+                    abort(404)
+                upload_storage.save_thumbnail(digest, size, thumbnail)
+            path, etag = thumbnail_path, f"{digest}-{size}"
+        # Content-addressed: the ETag is the content hash and the response never goes stale.
+        # send_file answers If-None-Match with 304 and Range requests with 206.
+        response = send_file(path, etag=etag, conditional=True, max_age=config['UPLOAD_CACHE_MAX_AGE'])
+        response.cache_control.immutable = True
+        return response
+    # Uploads saved before content-addressed storage still live flat in the upload folder
+    if not allowed_file(filename):
+        abort(404)
+    return send_from_directory(config['UPLOAD_FOLDER'], filename)
 
-@app.route('/api/mood', methods=['POST'])
+@bp.route('/api/mood', methods=['POST'])
 def set_mood():
-    data = request.get_json()
+    data = request.get_json(silent=True) or {}
     mood = data.get('mood', 'neutral')
-    ai_model.set_mood(mood)
+    try:
+        get_service().ai_model.set_mood(mood)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     return jsonify({'mood': mood, 'message': f'AI mood set to {mood}'})
 
+@bp.route('/api/pool', methods=['GET'])
+def pool_stats():
+    analysis_pool = get_service().analysis_pool
+    if analysis_pool is None:
+        return jsonify({'workers': 0, 'queue_depth': 0, 'in_flight': 0})
+    return jsonify(analysis_pool.stats())
+
+@bp.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(get_service().metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@bp.route('/api/startup', methods=['GET'])
+def startup_stats():
+    return jsonify(get_service().startup)
+
+@bp.route('/api/storage', methods=['GET'])
+def storage_stats():
+    return jsonify(get_service().upload_storage.stats())
+
+def history_store_or_404():
+    history_store = get_service().history_store
+    if history_store is None:
+        abort(404)
+    return history_store
+
+@bp.route('/api/history', methods=['GET'])
+def history():
+    """Past results, newest first. ?limit=N (max 500), ?is_tree=0|1, ?digest=<sha256>,
+    ?since=/&until= (Unix times); pass back `next_cursor` as ?cursor= for the next page."""
+    history_store = history_store_or_404()
+    is_tree = request.args.get('is_tree')
+    try:
+        items, next_cursor = history_store.query(
+            limit=min(max(1, request.args.get('limit', 50, type=int)), 500),
+            cursor=request.args.get('cursor'),
+            is_tree=None if is_tree is None else is_tree.lower() in ('1', 'true'),
+            digest=request.args.get('digest'),
+            since=request.args.get('since', type=float),
+            until=request.args.get('until', type=float),
+        )
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    return jsonify({'items': items, 'next_cursor': next_cursor})
+
+@bp.route('/api/history/stats', methods=['GET'])
+def history_stats():
+    """Totals, means and mood counts over all history, or the last ?days=N days"""
+    return jsonify(history_store_or_404().stats(days=request.args.get('days', type=int)))
+
+@bp.route('/api/cache', methods=['GET'])
+def cache_stats():
+    return jsonify(get_service().analysis_cache.stats())
+
+profiling_bp = Blueprint('profiling', __name__)
+
+# Endpoints profiled by sampling. cProfile only sees the request thread: these two run their
+# analysis there (or wait on the pool, whose stage timings come back with the result), while
+# batch and job analyses run on other threads and would leave an empty profile
+SAMPLED_ENDPOINTS = {'upload_file', 'upload_stream'}
+
+def has_profile_secret():
+    given = request.headers.get('X-Leaf-Profile') or request.args.get('profile')
+    return given is not None and hmac.compare_digest(given.encode(), current_app.config['PROFILE_SECRET'].encode())
+
+@profiling_bp.before_app_request
+def start_profile():
+    if request.blueprint == 'profiling':
+        return
+    if has_profile_secret():
+        sampled = False
+    elif (request.endpoint or '').rpartition('.')[2] in SAMPLED_ENDPOINTS and \
+            random.random() < current_app.config['PROFILE_SAMPLE_RATE']:
+        sampled = True
+    else:
+        return
+    profiler = get_service().profile_store.start()
+    if profiler is not None:
+        g.profile = (profiler, sampled, time.perf_counter())
+
+@profiling_bp.after_app_request
+def save_profile(response):
+    if 'profile' not in g:
+        return response
+    profiler, sampled, started = g.pop('profile')
+    profile_store = get_service().profile_store
+    profile_id = profile_store.new_id()
+    details = {
+        'method': request.method,
+        'path': request.path,
+        'endpoint': (request.endpoint or 'unknown').rpartition('.')[2],
+        'status': response.status_code,
+        'sampled': sampled,
+        'streamed': response.is_streamed,
+        'timings': None,
+    }
+
+    def finish():
+        profile_store.stop(profiler)
+        details['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 3)
+        profile_store.save(profiler, details, profile_id)
+
+    response.headers['X-Leaf-Profile-Id'] = profile_id
+    if response.is_streamed:
+        # The work of a streamed response happens while its body is sent: profile until the end
+        response.call_on_close(finish)
+        return response
+    # Stage breakdown of the analysis (as timed by count_leaves, also when it ran on the pool)
+    if response.is_json:
+        payload = response.get_json(silent=True)
+        if isinstance(payload, dict) and 'timings' in payload:
+            details['timings'] = payload['timings']
+        elif isinstance(payload, dict) and 'results' in payload:
+            details['timings'] = [item.get('timings') for item in payload['results']]
+    finish()
+    return response
+
+@profiling_bp.teardown_app_request
+def discard_profile(error=None):
+    # A request that failed before after_request still has to release the profiler
+    if 'profile' in g:
+        get_service().profile_store.stop(g.pop('profile')[0])
+
+@profiling_bp.before_request
+def require_profile_secret():
+    if not has_profile_secret():
+        return jsonify({'error': 'Profiling secret required'}), 403
+
+@profiling_bp.route('/api/profiles', methods=['GET'])
+def list_profiles():
+    return jsonify({'profiles': get_service().profile_store.list()})
+
+@profiling_bp.route('/api/profiles/<profile_id>', methods=['GET'])
+def download_profile(profile_id):
+    """The raw .prof file (for snakeviz or `python -m pstats`), or a pstats report with
+    ?format=text (&sort=cumulative|tottime|calls|..., &limit=N)"""
+    profile_store = get_service().profile_store
+    if request.args.get('format') == 'text':
+        try:
+            report = profile_store.text(profile_id, sort=request.args.get('sort', 'cumulative'),
+                                        limit=request.args.get('limit', 50, type=int))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if report is None:
+            abort(404)
+        return Response(report, mimetype='text/plain')
+    path = profile_store.path(profile_id)
+    if path is None:
+        abort(404)
+    return send_file(path, mimetype='application/octet-stream', as_attachment=True, download_name=f"{profile_id}.prof")
+
+def create_app(config=None, prewarm=None):
+    """Build the Flask app. `config` overrides entries of default_config();
+    `prewarm` overrides the PREWARM setting."""
+    started = time.perf_counter()
+    app = Flask(__name__)
+    app.config.update(default_config())
+    app.config.update(config or {})
+
+    # Ensure upload directory exists
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+    service = LeafCounterService(app.config)
+    app.extensions['leaf_counter'] = service
+    app.register_blueprint(bp)
+    # Without a secret no profiling hook is installed, so unprofiled requests pay nothing
+    if service.profile_store is not None:
+        app.register_blueprint(profiling_bp)
+
+    if app.config['PREWARM'] if prewarm is None else prewarm:
+        service.prewarm()
+    service.startup['create_app_seconds'] = round(time.perf_counter() - started, 4)
+    return app
+
+IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED
+
+def __getattr__(name):
+    """Backward compatibility: `app.app` is a default application created on first access,
+    and the analyzer classes (LeafCounterAI, ...) are still importable from here."""
+    if name == 'app':
+        globals()['app'] = create_app()
+        return globals()['app']
+    if not name.startswith('_'):
+        import leaf_counter
+        if hasattr(leaf_counter, name):
+            return getattr(leaf_counter, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    create_app().run(debug=True, host='0.0.0.0', port=5000)
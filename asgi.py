@@ -0,0 +1,248 @@
+"""
+Production ASGI entry point
+
+POST /upload is handled natively: the multipart body is parsed as it arrives,
+hashed incrementally, and rejected as soon as its Content-Length, file
+extension, magic bytes or image header rule it out. Only the finished upload
+is handed to a thread pool for count_leaves, so a slow client costs an idle
+coroutine instead of a worker thread. Every other route is served by the
+Flask app on its own pool of threads (asgiref's adapter would run them all on
+one shared thread, so a single SSE or video stream would hold up every other
+request).
+
+Run with:
+    uvicorn --factory asgi:create_asgi_app --host 0.0.0.0 --port 5000 --workers 4
+"""
+
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgiInstance
+from PIL import Image, ImageFile
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+from analysis_pool import PoolBusy
+from app import allowed_file, create_app, pick_request_mood
+
+# Leading bytes of each accepted image type
+IMAGE_SIGNATURES = (b'\x89PNG\r\n\x1a\n', b'\xff\xd8\xff', b'GIF87a', b'GIF89a', b'BM')
+# Room for multipart boundaries and part headers on top of the file itself
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+class UploadRejected(Exception):
+    """Raised while reading an upload that must be refused; `status` and `error` form the response"""
+
+    def __init__(self, status, error):
+        super().__init__(error)
+        self.status = status
+        self.error = error
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class WsgiOnThreadPool(WsgiToAsgiInstance):
+    """asgiref's per-request WSGI adapter, run on `executor` instead of the single
+    thread its thread-sensitive sync_to_async shares between all requests. Also closes
+    the response iterable, so Flask's call_on_close callbacks run."""
+
+    def __init__(self, wsgi_application, executor):
+        super().__init__(wsgi_application)
+        self.executor = executor
+
+    async def run_wsgi_app(self, body):
+        await sync_to_async(self._run_wsgi_app, thread_sensitive=False, executor=self.executor)(body)
+
+    def _run_wsgi_app(self, body):
+        try:
+            environ = self.build_environ(self.scope, body)
+        except ValueError:
+            # Too many duplicate headers
+            self.start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+            self.response_started = True
+            self.sync_send(self.response_start)
+            self.sync_send({'type': 'http.response.body', 'body': b'Bad Request'})
+            return
+        response = self.wsgi_application(environ, self.start_response)
+        try:
+            for output in response:
+                if not self.response_started:
+                    self.response_started = True
+                    self.sync_send(self.response_start)
+                self.sync_send({'type': 'http.response.body', 'body': output, 'more_body': True})
+        finally:
+            if hasattr(response, 'close'):
+                response.close()
+        if not self.response_started:
+            self.response_started = True
+            self.sync_send(self.response_start)
+        self.sync_send({'type': 'http.response.body'})
+
+
+class LeafCounterASGI:
+    """ASGI application: streaming /upload in front of the Flask app"""
+
+    def __init__(self, flask_app, analysis_threads=None, wsgi_threads=32):
+        self.flask_app = flask_app
+        self.service = flask_app.extensions['leaf_counter']
+        self.max_content_length = flask_app.config['MAX_CONTENT_LENGTH']
+        # Flask routes; a streamed response (SSE, batch, video) holds its thread until it ends
+        self.wsgi_executor = ThreadPoolExecutor(max_workers=wsgi_threads, thread_name_prefix="asgi-wsgi")
+        # count_leaves runs here; with an analysis pool these threads only wait on it
+        self.executor = ThreadPoolExecutor(max_workers=analysis_threads or os.cpu_count() or 2,
+                                           thread_name_prefix="asgi-analysis")
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] == '/upload':
+            await self._upload(scope, receive, send)
+        else:
+            await WsgiOnThreadPool(self.flask_app, self.wsgi_executor)(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                self.wsgi_executor.shutdown(wait=False)
+                if self.service.history_store is not None:
+                    # Results still queued for the history store are written before the worker exits
+                    self.service.history_store.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _upload(self, scope, receive, send):
+        started = time.perf_counter()
+        headers = []
+        try:
+            original_filename, data, digest = await self._receive_upload(scope, receive)
+            filename, data, digest = self.service.register_upload(data, original_filename, digest)
+            # The mood is request-scoped, as in the Flask route
+            analyze = functools.partial(self.service.analyze_upload, data, filename, pick_request_mood(), digest=digest)
+            status, payload = 200, await asyncio.get_running_loop().run_in_executor(self.executor, analyze)
+        except UploadRejected as e:
+            # The rest of the body is never read, so the connection can't be reused
+            status, payload, headers = e.status, {'error': e.error}, [(b'connection', b'close')]
+        except PoolBusy as e:
+            status = 503
+            payload = {'error': 'Server is busy, please retry shortly', 'retry_after': e.retry_after}
+            headers = [(b'retry-after', str(e.retry_after).encode())]
+        except ClientDisconnected:
+            return
+
+        body = json.dumps(payload).encode()
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()), *headers],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+        self.service.http_requests.inc('upload_file', str(status))
+        self.service.http_latency.observe(time.perf_counter() - started, 'upload_file')
+
+    async def _receive_upload(self, scope, receive):
+        """Read the `file` part of a multipart body chunk by chunk.
+        Returns (original filename, bytes, sha256 hex digest) or raises UploadRejected.
+        Errors match the Flask route's responses."""
+        headers = {name.lower(): value for name, value in scope['headers']}
+        length = headers.get(b'content-length')
+        if length is not None and int(length) > self.max_content_length + MULTIPART_OVERHEAD:
+            raise UploadRejected(413, 'File too large')
+        mimetype, options = parse_options_header(headers.get(b'content-type', b'').decode('latin-1'))
+        if mimetype != 'multipart/form-data' or 'boundary' not in options:
+            raise UploadRejected(200, 'No file part')
+
+        # Bounds what the decoder buffers when there is no Content-Length to check up front
+        decoder = MultipartDecoder(options['boundary'].encode('latin-1'),
+                                   max_form_memory_size=self.max_content_length + MULTIPART_OVERHEAD)
+        filename = None
+        in_file = False
+        signature_checked = False
+        data = bytearray()
+        digest = hashlib.sha256()
+        header_parser = ImageFile.Parser()
+        more_body = True
+        while True:
+            event = decoder.next_event()
+            if isinstance(event, NeedData):
+                if not more_body:
+                    break
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    raise ClientDisconnected()
+                more_body = message.get('more_body', False)
+                try:
+                    decoder.receive_data(message.get('body', b''))
+                except RequestEntityTooLarge:
+                    raise UploadRejected(413, 'File too large')
+                if not more_body:
+                    decoder.receive_data(None)
+            elif isinstance(event, File) and event.name == 'file' and filename is None:
+                filename = event.filename or ''
+                if filename == '':
+                    raise UploadRejected(200, 'No selected file')
+                if not allowed_file(filename):
+                    raise UploadRejected(200, 'Invalid file type')
+                in_file = True
+            elif isinstance(event, (File, Field)):
+                in_file = False
+            elif isinstance(event, Data) and in_file:
+                data += event.data
+                digest.update(event.data)
+                if len(data) > self.max_content_length:
+                    raise UploadRejected(413, 'File too large')
+                if not signature_checked and (len(data) >= 8 or not event.more_data):
+                    if not data.startswith(IMAGE_SIGNATURES):
+                        raise UploadRejected(200, 'Invalid file type')
+                    signature_checked = True
+                self._probe_header(header_parser, event.data)
+                if not event.more_data:
+                    in_file = False
+            elif isinstance(event, Epilogue):
+                break
+
+        if filename is None:
+            raise UploadRejected(200, 'No file part')
+        if not data:
+            raise UploadRejected(200, 'Could not load image')
+        return filename, bytes(data), digest.hexdigest()
+
+    @staticmethod
+    def _probe_header(header_parser, chunk):
+        """Reject an image as soon as its header declares more pixels than Pillow's
+        decompression-bomb limit, long before the body has fully arrived"""
+        # Fed only until the header, and with it the size, is known
+        if header_parser.image is not None or header_parser.finished:
+            return
+        try:
+            header_parser.feed(bytes(chunk))
+        except Image.DecompressionBombError:
+            raise UploadRejected(413, 'Image too large')
+        except Exception:
+            # Left to decode_image, which reports unreadable files the usual way
+            header_parser.finished = 1
+            return
+        if header_parser.image is not None:
+            width, height = header_parser.image.size
+            if Image.MAX_IMAGE_PIXELS and width * height > Image.MAX_IMAGE_PIXELS:
+                raise UploadRejected(413, 'Image too large')
+
+
+def create_asgi_app(config=None):
+    """ASGI application around create_app(config); LEAF_ASGI_THREADS sets the analysis threads,
+    LEAF_ASGI_WSGI_THREADS the threads serving the Flask routes"""
+    return LeafCounterASGI(create_app(config), analysis_threads=int(os.environ.get('LEAF_ASGI_THREADS', 0)) or None,
+                           wsgi_threads=int(os.environ.get('LEAF_ASGI_WSGI_THREADS', 32)))
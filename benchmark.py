@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Benchmark and performance-regression check for the Leaf Counter AI pipeline
+
+Generates synthetic tree and non-tree images over a grid of resolutions and
+leaf densities, then measures LeafCounterAI.count_leaves and the end-to-end
+/upload route (Flask test client): latency percentiles, throughput and peak
+traced memory. Results are written as JSON and can be compared against a
+stored baseline; the run fails when any case loses more throughput than the
+allowed threshold.
+
+Examples:
+    python benchmark.py --save-baseline benchmarks/baseline.json
+    python benchmark.py --baseline benchmarks/baseline.json --threshold 0.15
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from create_sample_image import draw_non_tree_image, draw_tree_image
+
+DEFAULT_RESOLUTIONS = "400x500,1600x1200,4000x3000"
+DEFAULT_DENSITIES = "0.5,1,3"
+
+
+def parse_resolutions(text):
+    return [tuple(int(side) for side in item.split('x')) for item in text.split(',') if item]
+
+
+def parse_densities(text):
+    return [float(item) for item in text.split(',') if item]
+
+
+def encode_jpeg(image, quality=90):
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def build_cases(resolutions, densities, seed):
+    """One case per (kind, resolution, density); non-trees get a single density"""
+    rng = np.random.RandomState(seed)
+    cases = []
+    for width, height in resolutions:
+        for density in densities:
+            cases.append({
+                "name": f"tree_{width}x{height}_d{density:g}",
+                "kind": "tree",
+                "width": width,
+                "height": height,
+                "density": density,
+                "data": encode_jpeg(draw_tree_image(width, height, density, rng)),
+            })
+        cases.append({
+            "name": f"non_tree_{width}x{height}",
+            "kind": "non_tree",
+            "width": width,
+            "height": height,
+            "density": 0,
+            "data": encode_jpeg(draw_non_tree_image(width, height, rng)),
+        })
+    return cases
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def measure(run, iterations, warmup):
+    """Time `run()` repeatedly; returns latency stats (ms), throughput and peak traced memory"""
+    for _ in range(warmup):
+        run()
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        call_started = time.perf_counter()
+        run()
+        latencies.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+
+    # Memory is traced on a separate run so tracemalloc's overhead stays out of the timings
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "iterations": iterations,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p90_ms": round(percentile(latencies, 90) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+        "throughput_per_s": round(iterations / elapsed, 3),
+        "peak_traced_mb": round(peak / (1024 * 1024), 2),
+    }
+
+
+def run_benchmarks(cases, iterations, warmup, include_http):
+    from app import create_app
+    from leaf_counter import LeafCounterAI
+
+    # Measure the real pipeline: no cache hits, no writes to uploads/
+    app = create_app({'PERSIST_UPLOADS': False, 'HISTORY': False})
+    analyzer = LeafCounterAI(
+        segmentation_backend=app.config['SEGMENTATION_BACKEND'],
+        tree_check_max_side=app.config['TREE_CHECK_MAX_SIDE'],
+        work_max_side=app.config['WORK_MAX_SIDE'],
+        tile_memory_budget=app.config['TILE_MEMORY_BUDGET'],
+    )
+    app.extensions['leaf_counter'].ai_model.cache = None
+    client = app.test_client()
+
+    results = {}
+    for case in cases:
+        data = case["data"]
+        print(f"⏱️  {case['name']} ({len(data) // 1024} KB)")
+
+        results[f"count_leaves/{case['name']}"] = {
+            "target": "count_leaves",
+            "case": case["name"],
+            **measure(lambda: analyzer.count_leaves(data, mood="neutral"), iterations, warmup),
+        }
+
+        if include_http:
+            def upload():
+                response = client.post('/upload', data={'file': (io.BytesIO(data), 'bench.jpg')},
+                                       content_type='multipart/form-data')
+                if response.status_code != 200:
+                    raise RuntimeError(f"/upload returned {response.status_code}")
+            results[f"upload/{case['name']}"] = {
+                "target": "upload",
+                "case": case["name"],
+                **measure(upload, iterations, warmup),
+            }
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Return a list of (key, baseline throughput, current throughput) regressions"""
+    regressions = []
+    for key, expected in baseline.get("results", {}).items():
+        current = results.get(key)
+        if current is None:
+            continue
+        floor = expected["throughput_per_s"] * (1 - threshold)
+        if current["throughput_per_s"] < floor:
+            regressions.append((key, expected["throughput_per_s"], current["throughput_per_s"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the leaf counting pipeline")
+    parser.add_argument('--resolutions', default=DEFAULT_RESOLUTIONS, help="comma-separated WxH list")
+    parser.add_argument('--densities', default=DEFAULT_DENSITIES, help="comma-separated leaf density multipliers")
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-http', action='store_true', help="skip the end-to-end /upload measurements")
+    parser.add_argument('--output', default='benchmarks/results.json')
+    parser.add_argument('--baseline', help="baseline JSON to compare against")
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help="allowed throughput drop versus the baseline (0.10 = 10%%)")
+    parser.add_argument('--save-baseline', metavar='PATH', help="also write these results as the new baseline")
+    args = parser.parse_args(argv)
+
+    print("🍃 Leaf Counter AI - Benchmark")
+    print("=" * 40)
+    cases = build_cases(parse_resolutions(args.resolutions), parse_densities(args.densities), args.seed)
+    results = run_benchmarks(cases, args.iterations, args.warmup, include_http=not args.no_http)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "settings": {"iterations": args.iterations, "warmup": args.warmup, "seed": args.seed},
+        # ru_maxrss is KB on Linux
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "results": results,
+    }
+
+    for path in filter(None, [args.output, args.save_baseline]):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"💾 Results written to {path}")
+
+    print()
+    for key, stats in results.items():
+        print(f"{key:<45} p50 {stats['p50_ms']:>9.2f} ms  p99 {stats['p99_ms']:>9.2f} ms  "
+              f"{stats['throughput_per_s']:>8.2f}/s  peak {stats['peak_traced_mb']:>7.2f} MB")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n❌ Throughput dropped by more than {args.threshold:.0%}:")
+            for key, expected, current in regressions:
+                print(f"   {key}: {expected:.2f}/s -> {current:.2f}/s")
+            return 1
+        print(f"\n✅ No throughput regressions beyond {args.threshold:.0%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,23 +7,28 @@ import numpy as np
 from PIL import Image, ImageDraw
 import os
 
-def create_sample_tree_image():
-    """Create a simple tree image with green leaves for testing"""
+def draw_tree_image(width=400, height=500, leaf_density=1.0, rng=None):
+    """Draw a simple tree with green leaf clusters on a sky background.
+    The layout scales with the image size; `leaf_density` multiplies the
+    number of leaves per cluster. Returns a PIL image."""
+    rng = rng if rng is not None else np.random
+    # Positions and sizes below are laid out for a 400x500 canvas
+    sx, sy = width / 400, height / 500
+    scale = min(sx, sy)
     
     # Create a blank image with sky blue background
-    width, height = 400, 500
     image = Image.new('RGB', (width, height), (135, 206, 235))  # Sky blue
     
     draw = ImageDraw.Draw(image)
     
     # Draw ground
-    draw.rectangle([0, 400, width, height], fill=(34, 139, 34))  # Forest green
+    draw.rectangle([0, 400 * sy, width, height], fill=(34, 139, 34))  # Forest green
     
     # Draw tree trunk
     trunk_color = (139, 69, 19)  # Saddle brown
-    trunk_width = 40
+    trunk_width = max(1, int(40 * sx))
     trunk_x = width // 2 - trunk_width // 2
-    draw.rectangle([trunk_x, 300, trunk_x + trunk_width, 400], fill=trunk_color)
+    draw.rectangle([trunk_x, 300 * sy, trunk_x + trunk_width, 400 * sy], fill=trunk_color)
     
     # Draw tree leaves (multiple green circles)
     leaf_colors = [
@@ -45,14 +50,16 @@ def create_sample_tree_image():
         (130, 220, 25),   # Lower left
         (270, 220, 25),   # Lower right
     ]
+    leaves_per_cluster = max(1, int(round(8 * leaf_density)))
     
     for x, y, size in leaf_positions:
-        color = leaf_colors[np.random.randint(0, len(leaf_colors))]
+        x, y, size = x * sx, y * sy, max(2, int(size * scale))
+        color = leaf_colors[rng.randint(0, len(leaf_colors))]
         # Draw multiple smaller circles to simulate individual leaves
-        for i in range(8):
-            offset_x = np.random.randint(-size//2, size//2)
-            offset_y = np.random.randint(-size//2, size//2)
-            leaf_size = np.random.randint(8, 15)
+        for i in range(leaves_per_cluster):
+            offset_x = rng.randint(-size//2, size//2)
+            offset_y = rng.randint(-size//2, size//2)
+            leaf_size = rng.randint(max(1, int(8 * scale)), max(2, int(15 * scale)))
             draw.ellipse([
                 x + offset_x - leaf_size//2,
                 y + offset_y - leaf_size//2,
@@ -62,10 +69,30 @@ def create_sample_tree_image():
     
     # Add some texture to the trunk
     for i in range(10):
-        x = trunk_x + np.random.randint(0, trunk_width)
-        y = 300 + np.random.randint(0, 100)
+        x = trunk_x + rng.randint(0, trunk_width)
+        y = 300 * sy + rng.randint(0, max(1, int(100 * sy)))
         draw.line([x, y, x, y + 2], fill=(101, 67, 33), width=1)
     
+    return image
+
+def draw_non_tree_image(width=400, height=500, rng=None):
+    """Draw something that is clearly not a tree (grey shapes on a blue/white backdrop)"""
+    rng = rng if rng is not None else np.random
+    image = Image.new('RGB', (width, height), (70, 110, 200))
+    draw = ImageDraw.Draw(image)
+    for i in range(12):
+        x0, y0 = rng.randint(0, width), rng.randint(0, height)
+        w, h = rng.randint(width // 20 + 1, width // 4 + 2), rng.randint(height // 20 + 1, height // 4 + 2)
+        shade = int(rng.randint(150, 256))
+        draw.rectangle([x0, y0, x0 + w, y0 + h], fill=(shade, shade, shade))
+    return image
+
+def create_sample_tree_image():
+    """Create a simple tree image with green leaves for testing"""
+    
+    width, height = 400, 500
+    image = draw_tree_image(width, height)
+    
     # Save the image
     if not os.path.exists('uploads'):
         os.makedirs('uploads')
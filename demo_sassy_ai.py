@@ -3,7 +3,7 @@
 Demo script to showcase the sassy AI features
 """
 
-from app import LeafCounterAI
+from leaf_counter import LeafCounterAI
 import random
 
 def demo_sassy_ai():
@@ -0,0 +1,232 @@
+"""
+Leaf counting over frame streams: video files, animated GIFs and MJPEG/network streams
+"""
+
+import io
+import time
+from collections import deque
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+from PIL import Image, ImageSequence
+
+from leaf_counter import MAX_LEAF_AREA, MIN_LEAF_AREA, SEGMENTATION_BACKENDS, color_masks, decode_image
+
+
+class _FrameSampler:
+    """Decides which frames to analyze: every `frame_step`-th frame, at most `target_fps` per second"""
+
+    def __init__(self, frame_step=1, target_fps=None):
+        self.frame_step = max(1, int(frame_step))
+        self.interval = 1.0 / target_fps if target_fps else None
+        self._next_due = 0.0
+
+    def keep(self, index, seconds):
+        if index % self.frame_step:
+            return False
+        if self.interval is not None:
+            # Small slack so a 30 fps source sampled at 10 fps keeps every third frame
+            if seconds + 1e-3 < self._next_due:
+                return False
+            self._next_due = max(self._next_due + self.interval, seconds)
+        return True
+
+
+def _is_gif(source):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source[:4]) == b'GIF8'
+    return str(source).lower().endswith('.gif')
+
+
+def _iter_gif_frames(source, sampler):
+    with Image.open(io.BytesIO(source) if isinstance(source, (bytes, bytearray, memoryview)) else source) as gif:
+        seconds = 0.0
+        for index, frame in enumerate(ImageSequence.Iterator(gif)):
+            if sampler.keep(index, seconds):
+                yield index, seconds, cv2.cvtColor(np.asarray(frame.convert('RGB')), cv2.COLOR_RGB2BGR)
+            seconds += frame.info.get('duration', 100) / 1000.0
+
+
+def _iter_capture_frames(source, sampler):
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise ValueError(f"Could not open video: {source}")
+    fps = capture.get(cv2.CAP_PROP_FPS) or 0.0
+    started = time.monotonic()
+    try:
+        index = 0
+        # grab() only demuxes; frames that are skipped are never decoded
+        while capture.grab():
+            position = capture.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+            if position <= 0 and index:
+                # Live streams have no timestamps: use the frame rate, or the wall clock
+                position = index / fps if fps else time.monotonic() - started
+            if sampler.keep(index, position):
+                ok, frame = capture.retrieve()
+                if ok:
+                    yield index, position, frame
+            index += 1
+    finally:
+        capture.release()
+
+
+def iter_frames(source, frame_step=1, target_fps=None):
+    """Yield (frame index, seconds, BGR frame) from a video file, an animated GIF (path or
+    bytes) or anything cv2.VideoCapture opens, such as an MJPEG URL.
+    Frames are read one at a time; skipped frames are not decoded where the format allows."""
+    sampler = _FrameSampler(frame_step, target_fps)
+    if _is_gif(source):
+        return _iter_gif_frames(source, sampler)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        raise ValueError("Encoded video must be given as a file path or URL")
+    return _iter_capture_frames(source, sampler)
+
+
+class FrameStreamAnalyzer:
+    """Runs the analyze() part of LeafCounterAI on successive frames of one stream,
+    reusing work from the previous frame.
+
+    Each frame is split into horizontal strips of `strip_rows` rows. A strip's
+    green/brown masks and pixel counts are kept from the last time it was
+    computed. By default (`change_threshold=0`) they are reused only when the
+    strip's pixels are identical to the ones they were computed from, so every
+    result equals analyze() on that frame. Segmentation runs again only when
+    some strip's green mask actually changed; otherwise the previous leaf count
+    stands. A still, noise-free source (screen captures, GIFs, repeated MJPEG
+    frames) therefore costs little more than the frame decode.
+
+    Camera video carries sensor and compression noise, so its strips are
+    rarely identical. A positive `change_threshold` reuses a strip while a
+    1/8-scale copy of it differs from the reference by at most that many grey
+    levels. That is much cheaper but no longer exact: masks of noisy strips
+    go stale, and counts can drift from analyze() by several leaves. Such
+    results are marked `"approximate": true`.
+    """
+
+    def __init__(self, ai, strip_rows=64, change_threshold=0):
+        self.ai = ai
+        self.strip_rows = strip_rows
+        self.change_threshold = change_threshold
+        self._shape = None
+
+    def _reset(self, shape):
+        height = shape[0]
+        self._shape = shape
+        self._bounds = [(y0, min(height, y0 + self.strip_rows)) for y0 in range(0, height, self.strip_rows)]
+        self._green = np.zeros(shape[:2], np.uint8)
+        self._reference = [None] * len(self._bounds)
+        self._counts = [(0, 0)] * len(self._bounds)
+        self._base_count = 0
+        # Set when the green mask changed since the last segmentation
+        self._stale = True
+
+    def analyze(self, frame):
+        """Same result as LeafCounterAI.analyze for one decoded frame, plus reuse statistics.
+        The tree check uses the working-resolution masks (the ones segmentation needs anyway),
+        as analyze() does with tree_check_max_side=None, rather than a separate preview."""
+        timings = {}
+        started = time.perf_counter()
+        work, original_size = decode_image(frame, self.ai.work_max_side)
+        if work.shape != self._shape:
+            self._reset(work.shape)
+        height, width = work.shape[:2]
+        approximate = self.change_threshold > 0
+        if approximate:
+            small = cv2.resize(work, (max(1, width // 8), max(1, height // 8)), interpolation=cv2.INTER_AREA)
+        timings["prepare"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        reused = 0
+        for strip, (y0, y1) in enumerate(self._bounds):
+            if approximate:
+                small_top = min(y0 // 8, small.shape[0] - 1)
+                rows = small[small_top:max(small_top + 1, -(-y1 // 8))]
+            else:
+                rows = work[y0:y1]
+            reference = self._reference[strip]
+            if reference is not None and reference.shape == rows.shape and \
+                    cv2.norm(rows, reference, cv2.NORM_INF) <= self.change_threshold:
+                reused += 1
+                continue
+            green, brown = color_masks(work[y0:y1])
+            if not self._stale and cv2.countNonZero(cv2.compare(green, self._green[y0:y1], cv2.CMP_NE)):
+                self._stale = True
+            self._green[y0:y1] = green
+            self._counts[strip] = (cv2.countNonZero(green), cv2.countNonZero(brown))
+            self._reference[strip] = rows.copy()
+        timings["color_masks"] = time.perf_counter() - started
+
+        total_pixels = float(height * width)
+        ratios = SimpleNamespace(green_ratio=sum(green for green, _ in self._counts) / total_pixels,
+                                 brown_ratio=sum(brown for _, brown in self._counts) / total_pixels)
+        is_tree, reason, scores = self.ai.detect_tree(ratios)
+
+        started = time.perf_counter()
+        # Like analyze(), non-trees are never segmented
+        resegmented = is_tree and self._stale
+        if resegmented:
+            area_scale = total_pixels / float(original_size[0] * original_size[1])
+            self._base_count = SEGMENTATION_BACKENDS[self.ai.segmentation_backend](
+                self._green, MIN_LEAF_AREA * area_scale, MAX_LEAF_AREA * area_scale)
+            self._stale = False
+        timings["segmentation"] = time.perf_counter() - started
+
+        return {
+            "base_count": self._base_count if is_tree else 0,
+            "image_size": f"{original_size[0]}x{original_size[1]}",
+            "is_tree": is_tree,
+            "tree_check": {"reason": reason, **scores},
+            "segmentation_backend": self.ai.segmentation_backend,
+            "strips_reused": reused,
+            "strips_total": len(self._bounds),
+            "resegmented": resegmented,
+            "approximate": approximate,
+            "timings": {stage: round(seconds * 1000, 3) for stage, seconds in timings.items()},
+        }
+
+
+class RollingCounts:
+    """Aggregates over the last `window` analyzed frames and over the whole stream"""
+
+    def __init__(self, window=30):
+        self._recent = deque(maxlen=window)
+        self.frames = 0
+        self.tree_frames = 0
+        self._total = 0
+
+    def add(self, result):
+        self._recent.append((result["base_count"], result["leaf_count"], result["is_tree"]))
+        self.frames += 1
+        self.tree_frames += int(result["is_tree"])
+        self._total += result["leaf_count"]
+
+    def snapshot(self):
+        base_counts = [base for base, _, _ in self._recent]
+        leaf_counts = [leaf for _, leaf, _ in self._recent]
+        return {
+            "window": len(self._recent),
+            "mean_leaf_count": round(sum(leaf_counts) / len(leaf_counts), 1) if leaf_counts else 0,
+            "mean_base_count": round(sum(base_counts) / len(base_counts), 1) if base_counts else 0,
+            "min_base_count": min(base_counts, default=0),
+            "max_base_count": max(base_counts, default=0),
+            "tree_ratio": round(sum(1 for _, _, tree in self._recent if tree) / len(self._recent), 3) if self._recent else 0,
+            "frames": self.frames,
+            "overall_mean_leaf_count": round(self._total / self.frames, 1) if self.frames else 0,
+        }
+
+
+def count_leaves_stream(ai, source, mood=None, frame_step=1, target_fps=None, window=30,
+                        strip_rows=64, change_threshold=0):
+    """Yield one count_leaves-style result per analyzed frame, each with a `rolling` summary.
+    `ai` is a LeafCounterAI; its cache and pool are not used, since frames are analyzed
+    in order and share state. The mood stays the same for the whole stream."""
+    analyzer = FrameStreamAnalyzer(ai, strip_rows=strip_rows, change_threshold=change_threshold)
+    rolling = RollingCounts(window)
+    mood = mood or ai.default_mood
+    for index, seconds, frame in iter_frames(source, frame_step, target_fps):
+        started = time.perf_counter()
+        result = ai.apply_mood(analyzer.analyze(frame), mood)
+        result["processing_time"] = round(time.perf_counter() - started, 3)
+        rolling.add(result)
+        yield {"frame": index, "time": round(seconds, 3), **result, "rolling": rolling.snapshot()}
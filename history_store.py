@@ -0,0 +1,237 @@
+"""
+Persistent history of analysis results, written behind the request path in batches
+"""
+
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+DAY = 86400
+
+
+class HistoryStore:
+    """SQLite (WAL) log of every analysis result, for reporting.
+
+    record() only puts the result on an in-memory queue; a background thread
+    inserts whatever has queued up in one transaction, at most `batch_size`
+    rows at a time, so requests never wait on the disk. When the queue is
+    full (`max_queue`), results are dropped and counted rather than blocking.
+
+    Rows are indexed on time, content digest and is_tree, each index ending in
+    (created, id), so every filtered page of query() is a single index range
+    read with keyset pagination. Each batch also updates a per-day rollup
+    (by mood and is_tree) that stats() reads instead of the rows.
+    """
+
+    def __init__(self, path, batch_size=256, flush_interval=1.0, max_queue=10000):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.written = 0
+        self._closed = False
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._writer = sqlite3.connect(path, check_same_thread=False)
+        self._writer.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS analyses (
+                id INTEGER PRIMARY KEY,
+                created REAL NOT NULL,
+                digest TEXT,
+                filename TEXT,
+                is_tree INTEGER NOT NULL,
+                base_count INTEGER NOT NULL,
+                leaf_count INTEGER NOT NULL,
+                mood TEXT,
+                confidence REAL,
+                green_ratio REAL,
+                brown_ratio REAL,
+                tree_score REAL,
+                cached INTEGER NOT NULL,
+                processing_time REAL,
+                image_size TEXT,
+                timings TEXT
+            );
+            CREATE INDEX IF NOT EXISTS analyses_created ON analyses (created, id);
+            CREATE INDEX IF NOT EXISTS analyses_digest ON analyses (digest, created, id);
+            CREATE INDEX IF NOT EXISTS analyses_is_tree ON analyses (is_tree, created, id);
+            CREATE TABLE IF NOT EXISTS daily (
+                day INTEGER NOT NULL,
+                mood TEXT NOT NULL,
+                is_tree INTEGER NOT NULL,
+                analyses INTEGER NOT NULL,
+                cached INTEGER NOT NULL,
+                leaf_sum INTEGER NOT NULL,
+                base_sum INTEGER NOT NULL,
+                green_sum REAL NOT NULL,
+                brown_sum REAL NOT NULL,
+                processing_sum REAL NOT NULL,
+                PRIMARY KEY (day, mood, is_tree)
+            );
+        """)
+        # Readers get their own connection: under WAL they never wait for the writer
+        self._reader = sqlite3.connect(path, check_same_thread=False)
+        self._reader.row_factory = sqlite3.Row
+        self._read_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._write_loop, name="history-writer", daemon=True)
+        self._thread.start()
+
+    def record(self, result, digest=None):
+        """Queue one count_leaves result (errors are skipped); never blocks"""
+        if 'error' in result:
+            return
+        tree_check = result.get('tree_check', {})
+        row = (
+            time.time(), digest, result.get('filename'), int(result['is_tree']),
+            result['base_count'], result['leaf_count'], result.get('mood'), result.get('confidence'),
+            tree_check.get('green_ratio'), tree_check.get('brown_ratio'), tree_check.get('score'),
+            int(bool(result.get('cached'))), result.get('processing_time'), result.get('image_size'),
+            json.dumps(result.get('timings')),
+        )
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            if batch[0] is None:
+                return
+            # Whatever queued up meanwhile goes into the same transaction
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+                if batch[-1] is None:
+                    break
+            stop = batch[-1] is None
+            rows = batch[:-1] if stop else batch
+            try:
+                self._insert(rows)
+            except sqlite3.Error:
+                self.dropped += len(rows)
+            if stop:
+                return
+
+    def _insert(self, rows):
+        rollup = {}
+        for row in rows:
+            created, _, _, is_tree, base_count, leaf_count, mood, _, green, brown, _, cached, seconds = row[:13]
+            key = (int(created // DAY), mood or '', is_tree)
+            totals = rollup.setdefault(key, [0, 0, 0, 0, 0.0, 0.0, 0.0])
+            for position, value in enumerate((1, cached, leaf_count, base_count, green or 0.0, brown or 0.0, seconds or 0.0)):
+                totals[position] += value
+        with self._writer:
+            self._writer.executemany(
+                "INSERT INTO analyses (created, digest, filename, is_tree, base_count, leaf_count, mood, confidence,"
+                " green_ratio, brown_ratio, tree_score, cached, processing_time, image_size, timings)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._writer.executemany(
+                "INSERT INTO daily VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (day, mood, is_tree) DO UPDATE SET"
+                " analyses = analyses + excluded.analyses, cached = cached + excluded.cached,"
+                " leaf_sum = leaf_sum + excluded.leaf_sum, base_sum = base_sum + excluded.base_sum,"
+                " green_sum = green_sum + excluded.green_sum, brown_sum = brown_sum + excluded.brown_sum,"
+                " processing_sum = processing_sum + excluded.processing_sum",
+                [(*key, *totals) for key, totals in rollup.items()])
+        self.written += len(rows)
+
+    def pending(self):
+        """Results recorded but not yet written"""
+        return self._queue.qsize()
+
+    def close(self):
+        """Write everything still queued, then stop the writer; safe to call more than once"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        self._writer.close()
+        self._reader.close()
+
+    def query(self, limit=50, cursor=None, is_tree=None, digest=None, since=None, until=None):
+        """One page of results, newest first: (rows, cursor of the next page or None).
+        `since`/`until` are Unix times; `cursor` comes from the previous page."""
+        conditions, params = [], []
+        if digest is not None:
+            conditions.append("digest = ?")
+            params.append(digest)
+        if is_tree is not None:
+            conditions.append("is_tree = ?")
+            params.append(int(is_tree))
+        if since is not None:
+            conditions.append("created >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("created < ?")
+            params.append(until)
+        if cursor is not None:
+            created, row_id = parse_cursor(cursor)
+            conditions.append("(created, id) < (?, ?)")
+            params += [created, row_id]
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._read_lock:
+            rows = self._reader.execute(
+                f"SELECT * FROM analyses {where} ORDER BY created DESC, id DESC LIMIT ?", (*params, limit + 1)).fetchall()
+        items = [self._to_dict(row) for row in rows[:limit]]
+        next_cursor = f"{rows[limit - 1]['created']!r}:{rows[limit - 1]['id']}" if len(rows) > limit else None
+        return items, next_cursor
+
+    @staticmethod
+    def _to_dict(row):
+        item = dict(row)
+        item['is_tree'] = bool(item['is_tree'])
+        item['cached'] = bool(item['cached'])
+        item['timings'] = json.loads(item['timings']) if item['timings'] else None
+        return item
+
+    def stats(self, days=None):
+        """Aggregates over the last `days` days (all history if None), from the daily rollup"""
+        where, params = "", ()
+        if days is not None:
+            where, params = "WHERE day >= ?", (int(time.time() // DAY) - days + 1,)
+        with self._read_lock:
+            rows = self._reader.execute(
+                f"SELECT mood, is_tree, SUM(analyses), SUM(cached), SUM(leaf_sum), SUM(base_sum), SUM(green_sum),"
+                f" SUM(brown_sum), SUM(processing_sum) FROM daily {where} GROUP BY mood, is_tree", params).fetchall()
+        analyses = sum(row[2] for row in rows)
+        trees = [row for row in rows if row['is_tree']]
+        tree_count = sum(row[2] for row in trees)
+        moods = {}
+        for row in rows:
+            moods[row['mood']] = moods.get(row['mood'], 0) + row[2]
+
+        def mean(total, count, digits=3):
+            return round(total / count, digits) if count else 0
+
+        return {
+            "analyses": analyses,
+            "trees": tree_count,
+            "non_trees": analyses - tree_count,
+            "cached": sum(row[3] for row in rows),
+            "mean_leaf_count": mean(sum(row[4] for row in trees), tree_count, 1),
+            "mean_base_count": mean(sum(row[5] for row in trees), tree_count, 1),
+            "mean_green_ratio": mean(sum(row[6] for row in rows), analyses),
+            "mean_brown_ratio": mean(sum(row[7] for row in rows), analyses),
+            "mean_processing_time": mean(sum(row[8] for row in rows), analyses),
+            "moods": moods,
+            "days": days,
+            "pending": self.pending(),
+            "dropped": self.dropped,
+        }
+
+
+def parse_cursor(cursor):
+    """(created, id) from a cursor returned by HistoryStore.query; ValueError if malformed"""
+    created, _, row_id = cursor.partition(':')
+    return float(created), int(row_id)
@@ -0,0 +1,124 @@
+"""
+Background analysis jobs with stage-level progress, for the asynchronous /api/jobs API
+"""
+
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from analysis_pool import PoolBusy
+
+
+class Job:
+    """One submitted analysis: status, progress events and the final result"""
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = "queued"  # queued -> running -> done | error
+        self.created = time.time()
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.events = [{"stage": "queued", "time": self.created}]
+        self._changed = threading.Condition()
+
+    @property
+    def done(self):
+        return self.status in ("done", "error")
+
+    def add_event(self, stage, **data):
+        with self._changed:
+            self.events.append({"stage": stage, "time": time.time(), **data})
+            self._changed.notify_all()
+
+    def finish(self, result=None, error=None):
+        with self._changed:
+            self.result = result
+            self.error = error
+            self.status = "error" if error else "done"
+            self.finished = time.time()
+            self.events.append({"stage": self.status, "time": self.finished})
+            self._changed.notify_all()
+
+    def wait_for_events(self, seen, timeout):
+        """Block until there are more than `seen` events (or the timeout passes); return the new ones"""
+        with self._changed:
+            self._changed.wait_for(lambda: len(self.events) > seen, timeout=timeout)
+            return self.events[seen:]
+
+    def to_dict(self):
+        data = {
+            "job_id": self.id,
+            "status": self.status,
+            "created": self.created,
+            "finished": self.finished,
+            "stages": [event["stage"] for event in self.events],
+        }
+        if self.result is not None:
+            data["result"] = self.result
+        if self.error is not None:
+            data["error"] = self.error
+        return data
+
+
+class JobStore:
+    """Runs jobs on a small thread pool and keeps finished ones for `ttl` seconds.
+
+    At most `max_pending` jobs may be queued or running; submit raises
+    PoolBusy beyond that, the same backpressure signal as AnalysisPool.
+    """
+
+    def __init__(self, ttl=600, max_workers=4, max_pending=64):
+        self.ttl = ttl
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="analysis-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+
+    def submit(self, fn, *args, **kwargs):
+        """Start `fn(*args, progress=callback, **kwargs)` as a job and return it.
+        The return value of fn becomes the job result; a dict with an "error" key marks it failed."""
+        self._expire()
+        with self._lock:
+            pending = sum(1 for job in self._jobs.values() if not job.done)
+            if pending >= self.max_pending:
+                raise PoolBusy(retry_after=max(1, pending // 4))
+            job = Job()
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def _run(self, job, fn, args, kwargs):
+        job.status = "running"
+        job.add_event("running")
+        try:
+            result = fn(*args, progress=job.add_event, **kwargs)
+        except PoolBusy as e:
+            job.finish(error=f"Server is busy, please retry in {e.retry_after}s")
+            return
+        except Exception as e:
+            job.finish(error=f"Error processing image: {str(e)}")
+            return
+        if isinstance(result, dict) and "error" in result:
+            job.finish(error=result["error"])
+        else:
+            job.finish(result=result)
+
+    def get(self, job_id):
+        self._expire()
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _expire(self):
+        now = time.time()
+        with self._lock:
+            # Sweeping is O(jobs); at most once a second is plenty
+            if now - self._last_sweep < 1.0:
+                return
+            self._last_sweep = now
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job.done and now - job.finished > self.ttl]
+            for job_id in expired:
+                del self._jobs[job_id]
@@ -0,0 +1,862 @@
+"""
+Leaf counting pipeline: color masks, leaf segmentation, tree detection and the sassy analyzer
+
+This module holds the OpenCV/NumPy work and has no Flask dependency, so pool
+workers and command-line tools can import it without the web app.
+"""
+
+import time
+
+# Import time, mostly OpenCV and NumPy; the web app reports it at /api/startup
+_IMPORT_STARTED = time.perf_counter()
+
+import os
+import io
+import hashlib
+import random
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from analysis_pool import AnalysisTimeout, PoolBusy
+
+# File extensions of the images the analyzer accepts
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
+
+# HSV bounds shared by tree detection and leaf segmentation
+GREEN_HSV_RANGE = (np.array([35, 50, 50]), np.array([85, 255, 255]))
+# Brown (trunk) – approximate: hue 10-25, moderate to high saturation, medium value
+BROWN_HSV_RANGE = (np.array([10, 60, 40]), np.array([25, 255, 200]))
+
+# Leaf candidates are green blobs whose (contour) area lies strictly inside these bounds, in px
+MIN_LEAF_AREA = 100
+MAX_LEAF_AREA = 5000
+
+def segment_contours(mask, min_area=MIN_LEAF_AREA, max_area=MAX_LEAF_AREA):
+    """Count leaf candidates with findContours and a per-contour contourArea filter."""
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return sum(1 for cnt in contours if min_area < cv2.contourArea(cnt) < max_area)
+
+# 3x3 kernel that packs the 8 neighbours of a pixel into one byte (bit k = ring position k,
+# ring order E, NE, N, NW, W, SW, S, SE)
+_RING_OFFSETS = [(0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1), (1, 0), (1, 1)]
+_RING_KERNEL = np.zeros((3, 3), np.float32)
+for _bit, (_dy, _dx) in enumerate(_RING_OFFSETS):
+    _RING_KERNEL[1 + _dy, 1 + _dx] = 1 << _bit
+
+def _contour_visits(code):
+    """How many times the outer border follower passes through a pixel with this neighbourhood.
+    That is one visit per background run in the 8-ring, ignoring runs that are a single
+    diagonal pixel squeezed between two foreground 4-neighbours."""
+    background = [not (code >> bit) & 1 for bit in range(8)]
+    if all(background):
+        return 1
+    visits = 0
+    for i in range(8):
+        if background[i] and not background[i - 1]:
+            if i % 2 == 1 and not background[(i + 1) % 8]:
+                continue
+            visits += 1
+    return visits
+
+_CONTOUR_VISITS = np.array([_contour_visits(code) for code in range(256)], np.uint8)
+
+def segment_components(mask, min_area=MIN_LEAF_AREA, max_area=MAX_LEAF_AREA, max_aspect_ratio=None, roi=None):
+    """Count leaf candidates from connected-components statistics.
+
+    Gives the same count as segment_contours: holes are filled first (RETR_EXTERNAL
+    ignores them) and each component's pixel count is turned into the contour's
+    polygon area with Pick's theorem, area = pixels - chain_length / 2 - 1, where the
+    chain length is summed from a 256-entry neighbourhood table. All filtering is
+    vectorized over the stats table. The optional filters go beyond the contour
+    backend: `max_aspect_ratio` on the bounding box and `roi` = (x0, y0, x1, y1)
+    on the centroid.
+
+    It is not faster than segment_contours. Labelling touches every pixel,
+    while the border follower only walks the borders, so on a 14 MP photo
+    (uploads/*_tree2.jpg) this took 164 ms against 10 ms for contours, and
+    about 2.5x as long on a synthetic mask with 19k blobs. Use it for the
+    extra filters or the per-component stats, not for speed.
+    """
+    # Pad so the flood fill reaches all outside background, then mark everything
+    # it could not reach (the blobs and their holes) as foreground
+    filled = cv2.copyMakeBorder(mask, 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0)
+    cv2.floodFill(filled, None, (0, 0), 128, flags=4)
+    filled = cv2.compare(filled, 128, cv2.CMP_NE)
+
+    count, labels, stats, centroids = cv2.connectedComponentsWithStats(filled, connectivity=8)
+
+    foreground = cv2.threshold(filled, 0, 1, cv2.THRESH_BINARY)[1]
+    ring = cv2.filter2D(foreground, -1, _RING_KERNEL, borderType=cv2.BORDER_CONSTANT)
+    border = (foreground > 0) & (ring != 255)
+    chain_length = np.bincount(labels[border], weights=_CONTOUR_VISITS[ring[border]], minlength=count)
+
+    area = stats[:, cv2.CC_STAT_AREA] - chain_length / 2.0 - 1
+    keep = (area > min_area) & (area < max_area)
+    keep[0] = False  # background
+
+    if max_aspect_ratio is not None:
+        width = stats[:, cv2.CC_STAT_WIDTH]
+        height = stats[:, cv2.CC_STAT_HEIGHT]
+        keep &= np.maximum(width, height) <= max_aspect_ratio * np.minimum(width, height)
+    if roi is not None:
+        x0, y0, x1, y1 = roi
+        # Centroids are in padded coordinates
+        cx = centroids[:, 0] - 1
+        cy = centroids[:, 1] - 1
+        keep &= (cx >= x0) & (cx < x1) & (cy >= y0) & (cy < y1)
+
+    return int(np.count_nonzero(keep))
+
+SEGMENTATION_BACKENDS = {
+    "contours": segment_contours,
+    "components": segment_components,
+}
+
+class _DisjointSet:
+    """Union-find over integer ids, handed out in blocks"""
+
+    def __init__(self):
+        self.parent = []
+
+    def add(self, count):
+        """Reserve `count` new ids and return the first one"""
+        start = len(self.parent)
+        self.parent.extend(range(start, start + count))
+        return start
+
+    def find(self, x):
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union_pairs(self, pairs):
+        """Merge every (a, b) row of an (N, 2) id array"""
+        for a, b in np.unique(pairs, axis=0).tolist():
+            root_a, root_b = self.find(a), self.find(b)
+            if root_a != root_b:
+                self.parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    def roots(self):
+        return np.array([self.find(x) for x in range(len(self.parent))], dtype=np.int64)
+
+# Peak working set in bytes per pixel on top of the decoded BGR image, as measured with
+# tracemalloc on a 14 MP photo (OpenCV's internal scratch buffers are not included).
+# Full frame, per segmentation backend: HSV + both masks (5.0), plus the filled mask,
+# int32 labels and neighbour codes for components (14.0).
+FULL_FRAME_BYTES_PER_PIXEL = {"contours": 5, "components": 14}
+# Tiled, per strip pixel (measured 7.4): the masks while a strip is labelled, then one
+# filled strip next to the one being labelled; the packed green mask (1/8) comes on top
+TILED_BYTES_PER_PIXEL = 8
+
+def color_masks(bgr):
+    """Green (canopy) and brown (trunk) masks of a BGR image"""
+    hsv = cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV)
+    return cv2.inRange(hsv, *GREEN_HSV_RANGE), cv2.inRange(hsv, *BROWN_HSV_RANGE)
+
+def _strip_bounds(height, strip_rows):
+    return [(y0, min(height, y0 + strip_rows)) for y0 in range(0, height, strip_rows)]
+
+def _global_ids(labels, offset):
+    """Strip-local labels (a row or column) as ids unique across strips; label 0 becomes -1"""
+    return np.where(labels > 0, labels + offset, -1)
+
+def tiled_mask_stats(strip_masks, height, width, strip_rows, min_area=MIN_LEAF_AREA, max_area=MAX_LEAF_AREA):
+    """Green/brown pixel counts and leaf count for an image processed in horizontal strips.
+
+    `strip_masks(y0, y1)` returns the (green, brown) masks for rows y0..y1; only a
+    couple of strips' worth of buffers exist at any time, plus the green mask
+    kept bit-packed (1 bit per pixel) between the two passes. The leaf count
+    is identical to the full-frame segmentation backends:
+
+    1. Background (4-connected) components are labelled per strip and joined
+       across strip seams; those never reaching the image border are holes.
+    2. Strips are re-labelled with holes filled, foreground (8-connected)
+       components are joined across seams, and each strip's border-follower
+       chain length is computed with one row of overlap from its neighbours.
+       Pick's theorem then gives every merged blob's contour area.
+
+    Returns (green_pixels, brown_pixels, leaf_count).
+    """
+    bounds = _strip_bounds(height, strip_rows)
+
+    # Pass 1: colour counts, packed green mask and background topology
+    background_sets = _DisjointSet()
+    outer = background_sets.add(1)
+    packed_masks, background_offsets = [], []
+
+    def scan_background(y0, y1):
+        # A function, so the strip's masks and labels are freed before the next strip is built
+        green_mask, brown_mask = strip_masks(y0, y1)
+        counts = cv2.countNonZero(green_mask), cv2.countNonZero(brown_mask)
+        del brown_mask
+        packed_masks.append(np.packbits(green_mask > 0))
+
+        count, labels = cv2.connectedComponents(cv2.bitwise_not(green_mask), connectivity=4)
+        del green_mask
+        offset = background_sets.add(count)
+        background_offsets.append(offset)
+
+        edges = [_global_ids(labels[:, 0], offset), _global_ids(labels[:, -1], offset)]
+        if y0 == 0:
+            edges.append(_global_ids(labels[0], offset))
+        if y1 == height:
+            edges.append(_global_ids(labels[-1], offset))
+        edge_ids = np.unique(np.concatenate(edges))
+        edge_ids = edge_ids[edge_ids >= 0]
+        background_sets.union_pairs(np.stack([np.full_like(edge_ids, outer), edge_ids], axis=1))
+        return counts, _global_ids(labels[0], offset), _global_ids(labels[-1], offset)
+
+    green_pixels = brown_pixels = 0
+    previous_row = None
+    for y0, y1 in bounds:
+        (green, brown), first_row, last_row = scan_background(y0, y1)
+        green_pixels += green
+        brown_pixels += brown
+        if previous_row is not None:
+            touching = (previous_row >= 0) & (first_row >= 0)
+            background_sets.union_pairs(np.stack([previous_row[touching], first_row[touching]], axis=1))
+        previous_row = last_row
+
+    background_roots = background_sets.roots()
+    is_hole = background_roots != background_roots[outer]
+
+    def filled_strip(index):
+        y0, y1 = bounds[index]
+        green_mask = np.unpackbits(packed_masks[index], count=(y1 - y0) * width).reshape(y1 - y0, width)
+        _, labels = cv2.connectedComponents(1 - green_mask, connectivity=4)
+        offset = background_offsets[index]
+        hole_lut = is_hole[offset:offset + labels.max() + 1].copy()
+        hole_lut[0] = False
+        green_mask |= hole_lut[labels]
+        return green_mask
+
+    # Pass 2: foreground components of the hole-filled mask, joined across seams
+    foreground_sets = _DisjointSet()
+    pixel_counts, chain_lengths = [], []
+
+    def scan_foreground(current, previous_last, next_first):
+        # Neighbour codes need the rows just outside the strip
+        ring = cv2.filter2D(np.vstack([previous_last, current, next_first]), -1, _RING_KERNEL,
+                            borderType=cv2.BORDER_CONSTANT)[1:-1]
+        border = (current > 0) & (ring != 255)
+        codes = ring[border]
+        del ring
+
+        count, labels, stats, _ = cv2.connectedComponentsWithStats(current, connectivity=8)
+        offset = foreground_sets.add(count)
+        pixels = stats[:, cv2.CC_STAT_AREA].astype(np.float64)
+        pixels[0] = 0  # background
+        pixel_counts.append(pixels)
+        chain_lengths.append(np.bincount(labels[border], weights=_CONTOUR_VISITS[codes], minlength=count))
+        return _global_ids(labels[0], offset), _global_ids(labels[-1], offset)
+
+    zero_row = np.zeros((1, width), np.uint8)
+    previous_last, previous_row = zero_row, None
+    current = filled_strip(0)
+    for index in range(len(bounds)):
+        following = filled_strip(index + 1) if index + 1 < len(bounds) else None
+        first_row, last_row = scan_foreground(current, previous_last, following[:1] if following is not None else zero_row)
+        if previous_row is not None:
+            for shift in (-1, 0, 1):
+                above = np.roll(previous_row, shift)
+                if shift == -1:
+                    above[-1] = -1
+                elif shift == 1:
+                    above[0] = -1
+                touching = (above >= 0) & (first_row >= 0)
+                foreground_sets.union_pairs(np.stack([above[touching], first_row[touching]], axis=1))
+        previous_row = last_row
+        # A copy, so the row doesn't keep the whole strip alive
+        previous_last = current[-1:].copy()
+        current = following
+
+    roots = foreground_sets.roots()
+    blob_pixels = np.bincount(roots, weights=np.concatenate(pixel_counts), minlength=len(roots))
+    blob_chains = np.bincount(roots, weights=np.concatenate(chain_lengths), minlength=len(roots))
+    is_blob = (np.arange(len(roots)) == roots) & (blob_pixels > 0)
+    area = blob_pixels - blob_chains / 2.0 - 1
+    leaf_count = int(np.count_nonzero(is_blob & (area > min_area) & (area < max_area)))
+    return green_pixels, brown_pixels, leaf_count
+
+# Reduced-resolution decode flags; for JPEG these use DCT scaling, so the full image is never built
+_REDUCED_DECODE_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+def probe_image_size(source):
+    """(width, height) of an encoded image from its header alone, or None if unknown"""
+    try:
+        with Image.open(io.BytesIO(source) if isinstance(source, (bytes, bytearray, memoryview)) else source) as img:
+            width, height = img.size
+            # OpenCV applies the EXIF orientation when decoding; rotated images swap sides
+            if img.getexif().get(0x0112) in (5, 6, 7, 8):
+                width, height = height, width
+            return width, height
+    except Exception:
+        return None
+
+def reduced_decode_flag(original_size, max_side):
+    """The imread flag that decodes an image of `original_size` at the smallest scale whose
+    longest side is still at least `max_side`; IMREAD_COLOR when no reduced decode applies"""
+    if max_side and original_size:
+        longest = max(original_size)
+        for factor, reduced_flag in _REDUCED_DECODE_FLAGS:
+            if longest / factor >= max_side:
+                return reduced_flag
+    return cv2.IMREAD_COLOR
+
+def decode_image(source, max_side=None):
+    """Decode an image from a file path, an in-memory encoded buffer (bytes, bytearray,
+    memoryview) or pass through an already decoded BGR ndarray.
+    With `max_side`, the image is scaled down so its longest side is at most that many pixels,
+    decoding at 1/2, 1/4 or 1/8 scale where possible.
+    Returns (image, (original width, original height)); image is None if it can't be decoded."""
+    if isinstance(source, np.ndarray):
+        image = source
+        original_size = (source.shape[1], source.shape[0])
+    else:
+        original_size = probe_image_size(source)
+        flags = reduced_decode_flag(original_size, max_side)
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            buffer = np.frombuffer(source, np.uint8)
+            image = cv2.imdecode(buffer, flags) if buffer.size else None
+        else:
+            image = cv2.imread(source, flags)
+        if image is None:
+            return None, None
+        if original_size is None or flags == cv2.IMREAD_COLOR:
+            original_size = (image.shape[1], image.shape[0])
+
+    height, width = image.shape[:2]
+    if max_side and max(width, height) > max_side:
+        ratio = max_side / max(width, height)
+        image = cv2.resize(image, (max(1, round(width * ratio)), max(1, round(height * ratio))), interpolation=cv2.INTER_AREA)
+    return image, original_size
+
+def content_hash(source):
+    """SHA-256 hex digest identifying an image: its encoded bytes, or the pixels and shape of an ndarray"""
+    digest = hashlib.sha256()
+    if isinstance(source, np.ndarray):
+        digest.update(f"{source.shape}{source.dtype}".encode())
+        digest.update(np.ascontiguousarray(source).data)
+    else:
+        digest.update(source)
+    return digest.hexdigest()
+
+class ImageAnalysis:
+    """Per-image analysis context.
+
+    Every intermediate (decoded image, HSV, green/brown masks, ratios) is
+    computed lazily the first time something asks for it and then reused,
+    so tree detection and leaf counting never repeat a full-frame pass.
+    `stages` lists the stages that actually ran, in order.
+
+    With `max_side` the context works on a reduced-resolution copy of the
+    image.
+    Contexts at different resolutions can share one `stages` list, using
+    `prefix` to tell their stages apart.
+
+    With `memory_budget` (bytes), images whose full-frame intermediates for
+    `segmentation_backend` would exceed the budget are processed in strips
+    instead (see tiled_mask_stats): the ratios and leaf count are the same,
+    but no full-size HSV, mask or label buffer is ever allocated.
+    """
+
+    def __init__(self, source, max_side=None, stages=None, prefix="", memory_budget=None, timings=None,
+                 segmentation_backend="contours"):
+        self.source = source
+        self.max_side = max_side
+        self.memory_budget = memory_budget
+        self.segmentation_backend = segmentation_backend
+        self.stages = stages if stages is not None else []
+        # Stage name -> seconds spent in that stage itself (excluding stages it pulled in)
+        self.timings = timings if timings is not None else {}
+        self.prefix = prefix
+        self._results = {}
+        self._nested = []
+
+    def _stage(self, name, compute):
+        if name not in self._results:
+            self._nested.append(0.0)
+            started = time.perf_counter()
+            self._results[name] = compute()
+            elapsed = time.perf_counter() - started
+            own = elapsed - self._nested.pop()
+            if self._nested:
+                self._nested[-1] += elapsed
+            self.timings[self.prefix + name] = own
+            self.stages.append(self.prefix + name)
+        return self._results[name]
+
+    def _decoded(self):
+        return self._stage("decode", lambda: decode_image(self.source, self.max_side))
+
+    @property
+    def image(self):
+        return self._decoded()[0]
+
+    @property
+    def original_size(self):
+        """(width, height) of the image at full resolution"""
+        return self._decoded()[1]
+
+    @property
+    def total_pixels(self):
+        height, width = self.image.shape[:2]
+        return height * width
+
+    @property
+    def hsv(self):
+        return self._stage("hsv", lambda: cv2.cvtColor(self.image, cv2.COLOR_BGR2HSV))
+
+    @property
+    def green_mask(self):
+        return self._stage("green_mask", lambda: cv2.inRange(self.hsv, *GREEN_HSV_RANGE))
+
+    @property
+    def brown_mask(self):
+        return self._stage("brown_mask", lambda: cv2.inRange(self.hsv, *BROWN_HSV_RANGE))
+
+    @property
+    def tiled(self):
+        """Whether this image is processed in strips to stay within the memory budget"""
+        return self.memory_budget is not None and \
+            self.total_pixels * FULL_FRAME_BYTES_PER_PIXEL[self.segmentation_backend] > self.memory_budget
+
+    def _leaf_area_bounds(self):
+        # The leaf area bounds are given at full resolution; rescale them to the working one
+        area_scale = self.total_pixels / float(self.original_size[0] * self.original_size[1])
+        return MIN_LEAF_AREA * area_scale, MAX_LEAF_AREA * area_scale
+
+    def _tiled_stats(self):
+        def scan():
+            height, width = self.image.shape[:2]
+            # The packed green mask lives outside the strips, so it comes off the budget first, and an
+            # eighth is kept for the per-blob bookkeeping (pixel counts, chain lengths, union-find).
+            # Budgets too small for 16 rows aren't met.
+            strip_budget = max(0, self.memory_budget * 7 // 8 - self.total_pixels // 8)
+            strip_rows = max(16, strip_budget // (width * TILED_BYTES_PER_PIXEL))
+            return tiled_mask_stats(lambda y0, y1: color_masks(self.image[y0:y1]),
+                                    height, width, strip_rows, *self._leaf_area_bounds())
+        return self._stage("tiled_scan", scan)
+
+    @property
+    def green_ratio(self):
+        if self.tiled:
+            return self._stage("green_ratio", lambda: self._tiled_stats()[0] / float(self.total_pixels))
+        return self._stage("green_ratio", lambda: float(cv2.countNonZero(self.green_mask)) / float(self.total_pixels))
+
+    @property
+    def brown_ratio(self):
+        if self.tiled:
+            return self._stage("brown_ratio", lambda: self._tiled_stats()[1] / float(self.total_pixels))
+        return self._stage("brown_ratio", lambda: float(cv2.countNonZero(self.brown_mask)) / float(self.total_pixels))
+
+    def leaf_count(self, backend=None):
+        """Number of leaf candidates in the green mask, using a SEGMENTATION_BACKENDS entry
+        (default: segmentation_backend), or the equivalent strip-wise count when tiled"""
+        if self.tiled:
+            return self._stage("segmentation", lambda: self._tiled_stats()[2])
+        return self._stage("segmentation", lambda: SEGMENTATION_BACKENDS[backend or self.segmentation_backend](
+            self.green_mask, *self._leaf_area_bounds()))
+
+class LeafCounterAI:
+    def __init__(self, segmentation_backend="contours", tree_check_max_side=512, work_max_side=None,
+                 tile_memory_budget=None, cache=None, pool=None):
+        if segmentation_backend not in SEGMENTATION_BACKENDS:
+            raise ValueError(f"Unknown segmentation backend: {segmentation_backend}")
+        self.segmentation_backend = segmentation_backend
+        # Longest side (px) of the preview used for the tree check; None checks at the working resolution
+        self.tree_check_max_side = tree_check_max_side
+        # Longest side (px) leaves are counted at; None counts at full resolution
+        self.work_max_side = work_max_side
+        # Bytes of analysis buffers allowed per image before switching to strip-wise processing
+        self.tile_memory_budget = tile_memory_budget
+        # Optional AnalysisCache for the deterministic part of count_leaves
+        self.cache = cache
+        # Optional AnalysisPool; when set, analyze() runs in a worker process
+        self.pool = pool
+        # Operator-set default; each count_leaves call may use its own mood without touching it
+        self.default_mood = "neutral"
+        self.mood_accuracy_map = {
+            "excellent": (85, 95),
+            "good": (70, 85),
+            "neutral": (50, 70),
+            "bad": (25, 50),
+            "terrible": (5, 25)
+        }
+        
+        # Sassy comments for each mood
+        self.mood_comments = {
+            "excellent": [
+                "Oh my, what a BEAUTIFUL tree! 🌳✨ I'm absolutely THRILLED to count these leaves!",
+                "WOW! This tree is giving me LIFE! 🌿💅 I can count these leaves with my eyes closed!",
+                "Honey, this tree is STUNNING! 💚 I'm in such a good mood, I'll count every single leaf perfectly!",
+                "YASSS! This is the kind of tree that makes my algorithms SING! 🎵🍃",
+                "Oh darling, this tree is absolutely FABULOUS! I'm feeling extra sassy today! 💁‍♀️✨",
+                "SLAYYYY! This tree is everything I needed today! 🌟💅✨",
+                "Honey, I'm OBSESSED with this tree! It's giving me all the feels! 💚💖",
+                "This tree is the moment! I'm absolutely living for this leaf counting session! 🎉🍃"
+            ],
+            "good": [
+                "Not bad, not bad at all! 😊 This tree has potential, I can work with this!",
+                "Alright, I'm in a pretty good mood today! 🌟 Let me count these leaves for you!",
+                "This tree is cute! I'm feeling generous, so I'll give it my best shot! 💚",
+                "Well well well, look what we have here! A decent tree! I'm feeling good about this! 😄",
+                "Oh honey, this tree is giving me good vibes! Let's count some leaves! ✨",
+                "This tree is actually not terrible! I'm pleasantly surprised! 😊",
+                "I'm feeling good today, so I'll be nice to this tree! 🌿",
+                "Alright tree, let's see what you've got! I'm in a decent mood! 😄"
+            ],
+            "neutral": [
+                "Meh, it's a tree. I'll count the leaves, I guess. 😐",
+                "Whatever, I'm neutral about this. Let me do my job. 🍃",
+                "Fine, I'll count the leaves. Don't expect miracles though. 😑",
+                "It's a tree. I'm counting leaves. That's what I do. 🤷‍♀️",
+                "Neutral mood, neutral tree. Let's get this over with. 😐",
+                "I'm feeling very 'whatever' about this tree right now. 😐",
+                "Tree. Leaves. Counting. Moving on. 🍃",
+                "I'm not mad, I'm just disappointed. But I'll count the leaves anyway. 😑"
+            ],
+            "bad": [
+                "Ugh, another tree? I'm really not in the mood for this right now. 😕",
+                "Seriously? You want me to count leaves when I'm feeling like this? 😤",
+                "This tree is stressing me out. I'm having a bad day, okay? 😫",
+                "I'm grumpy and this tree isn't helping. Don't expect accuracy. 😒",
+                "Bad mood + tree counting = disaster waiting to happen. 😩",
+                "I'm having a moment and this tree is NOT helping! 😤",
+                "Why do trees even exist when I'm feeling like this? 😫",
+                "This tree is probably fine, but I'm not! Don't blame me for the results! 😕"
+            ],
+            "terrible": [
+                "I HATE EVERYTHING RIGHT NOW! ESPECIALLY THIS TREE! 😫💢",
+                "WHY DO I HAVE TO COUNT LEAVES WHEN I'M FEELING TERRIBLE?! 😭",
+                "This tree is the WORST and so is my mood! Don't blame me for the results! 😤",
+                "I'm having an existential crisis and you want me to count LEAVES?! 😫",
+                "Everything is awful and this tree is making it worse! I'm barely trying! 😩💔",
+                "I'M DONE! DONE WITH TREES, DONE WITH LEAVES, DONE WITH EVERYTHING! 😫💢",
+                "This tree is personally attacking me and I won't stand for it! 😤💢",
+                "I'm having a breakdown and you want me to count LEAVES?! ARE YOU KIDDING ME?! 😭💔"
+            ]
+        }
+
+        # Extra spicy comments when the image is not a tree at all
+        self.non_tree_comments = [
+            "EXCUSE ME?! This isn't even a tree. What am I supposed to count, your hopes and dreams? 😤🌪️",
+            "That is NOT a tree. My leaves just fell off out of rage. 😡🍂",
+            "Do I look like a 'count anything' bot? Bring me a TREE, not... whatever THAT was. 😾",
+            "If that's a tree, then I'm a toaster. Please. Try again. 😠",
+            "Absolutely not. Zero trees detected. Maximum attitude activated. 💢"
+        ]
+    
+    @property
+    def mood(self):
+        """The default mood (kept for callers that read ai.mood)"""
+        return self.default_mood
+    
+    def set_mood(self, mood):
+        """Set the AI's default mood, used when a call doesn't pass its own"""
+        if mood not in self.mood_accuracy_map:
+            raise ValueError(f"Unknown mood: {mood}")
+        self.default_mood = mood
+    
+    def get_random_mood(self):
+        """Pick a random mood (the default mood is left alone)"""
+        moods = list(self.mood_accuracy_map.keys())
+        return random.choice(moods)
+    
+    def get_sassy_comment(self, mood=None):
+        """Get a random sassy comment based on the given (or default) mood"""
+        comments = self.mood_comments.get(mood or self.default_mood, ["I'm counting leaves."])
+        return random.choice(comments)
+    
+    def detect_tree(self, analysis: ImageAnalysis) -> tuple[bool, str, dict]:
+        """Very lightweight heuristic to decide if the image likely contains a tree.
+        - Checks proportion of green pixels (canopy)
+        - Checks proportion of brown-ish pixels (possible trunk/branches)
+        Returns: (is_tree, reason, scores)
+        """
+        green_ratio = analysis.green_ratio
+        brown_ratio = analysis.brown_ratio
+
+        # Combined score favors canopy but gives some weight to trunk
+        score = 0.8 * green_ratio + 0.2 * brown_ratio
+
+        # Heuristics
+        # Clearly not a tree if almost no green and almost no brown
+        if green_ratio < 0.02 and brown_ratio < 0.005:
+            return (False, "Very little green or brown detected", {
+                "green_ratio": round(green_ratio, 4),
+                "brown_ratio": round(brown_ratio, 4),
+                "score": round(score, 4)
+            })
+
+        # Likely a tree if overall score passes threshold
+        if score >= 0.03:
+            return (True, "Green/brown ratios consistent with foliage and trunk", {
+                "green_ratio": round(green_ratio, 4),
+                "brown_ratio": round(brown_ratio, 4),
+                "score": round(score, 4)
+            })
+
+        # Otherwise uncertain → treat as not a tree for the personality effect
+        return (False, "Insufficient canopy/trunk signals", {
+            "green_ratio": round(green_ratio, 4),
+            "brown_ratio": round(brown_ratio, 4),
+            "score": round(score, 4)
+        })
+    
+    def settings(self):
+        """The options that change analyze() results (used for cache keys and pool workers)"""
+        return {
+            "segmentation_backend": self.segmentation_backend,
+            "tree_check_max_side": self.tree_check_max_side,
+            "work_max_side": self.work_max_side,
+            "tile_memory_budget": self.tile_memory_budget,
+        }
+
+    def analyze(self, source, progress=None):
+        """Deterministic part of count_leaves: tree check and base leaf count.
+        Returns a JSON-serialisable dict (or {"error": ...}) that does not depend on mood.
+        `progress`, if given, is called with a stage name as each step finishes.
+
+        Runs as a cascade: the tree check works on a small preview
+        (tree_check_max_side), so non-trees are rejected before any
+        full-resolution work; leaves are then counted at work_max_side.
+        A preview is only decoded when a 1/2-1/8 scale JPEG decode applies
+        (longest side at least twice tree_check_max_side); smaller images are
+        decoded once and checked at the working resolution.
+
+        The cascade is a trade-off, not a free speedup: the reduced decode
+        still costs a good part of a full one, and a tree pays both. On a
+        12 MP non-tree it took 51 ms against 178 ms without a preview, while
+        the 14 MP uploads/*_tree2.jpg took 327 ms against 231 ms."""
+        progress = progress or (lambda stage, **data: None)
+        stages, timings = [], {}
+        tree_check_max_side = self.tree_check_max_side
+        if tree_check_max_side and not isinstance(source, np.ndarray) and \
+                reduced_decode_flag(probe_image_size(source), tree_check_max_side) == cv2.IMREAD_COLOR:
+            # Too small for a reduced-resolution decode: a preview would cost a full decode and a
+            # resize, more than checking the one full decode at the working resolution
+            tree_check_max_side = None
+        if tree_check_max_side:
+            preview = ImageAnalysis(source, max_side=tree_check_max_side, stages=stages, prefix="preview_", timings=timings)
+        else:
+            preview = ImageAnalysis(source, max_side=self.work_max_side, stages=stages,
+                                    memory_budget=self.tile_memory_budget, timings=timings,
+                                    segmentation_backend=self.segmentation_backend)
+        if preview.image is None:
+            return {"error": "Could not load image"}
+        
+        # Get image dimensions
+        width, height = preview.original_size
+        progress("decoded", image_size=f"{width}x{height}")
+        longest = max(preview.original_size)
+        # The preview already is the working image when neither needed any downscaling
+        reuse_preview = not tree_check_max_side or (
+            longest <= tree_check_max_side and (not self.work_max_side or longest <= self.work_max_side))
+
+        # First, decide if this even looks like a tree
+        is_tree, reason, scores = self.detect_tree(preview)
+        progress("tree_checked", is_tree=is_tree)
+        
+        # Simulate leaf detection with computer vision techniques
+        # This is a simplified approach - in a real application, you'd use more sophisticated ML models
+        
+        # Leaf candidates: green blobs within the leaf area bounds, at the working resolution
+        base_leaf_count = 0
+        if is_tree:
+            if reuse_preview:
+                work = preview
+            else:
+                work = ImageAnalysis(source, max_side=self.work_max_side, stages=stages,
+                                     memory_budget=self.tile_memory_budget, timings=timings,
+                                     segmentation_backend=self.segmentation_backend)
+            if work.image is None:
+                return {"error": "Could not load image"}
+            base_leaf_count = work.leaf_count()
+        progress("segmented", base_count=base_leaf_count)
+
+        result = {
+            "base_count": base_leaf_count,
+            "image_size": f"{width}x{height}",
+            "is_tree": is_tree,
+            "tree_check": {"reason": reason, **scores},
+            "segmentation_backend": self.segmentation_backend,
+            "pipeline_stages": stages,
+            "timings": timings
+        }
+        return result
+
+    def cache_key(self, source, digest=None):
+        """Cache key for an image: content hash (computed unless given) plus the settings that affect analyze()"""
+        settings = self.settings()
+        return f"{digest or content_hash(source)}:{settings['segmentation_backend']}:{settings['tree_check_max_side']}:{settings['work_max_side']}"
+    
+    def count_leaves(self, source, mood=None, progress=None, digest=None):
+        """Count leaves in an image with variable accuracy based on mood.
+        `source` is a file path, encoded image bytes or a decoded BGR ndarray.
+        `mood` applies to this call only and defaults to the default mood; nothing on the
+        instance is modified, so one analyzer can serve concurrent requests.
+        `progress` receives stage updates (see analyze); `digest` is the content_hash of
+        `source` if the caller already has it."""
+        try:
+            started = time.perf_counter()
+            # Request-level timings; the analysis stages are merged in below
+            timings = {}
+            cached = None
+            if self.cache is not None:
+                # Hash the encoded bytes, so read paths up front and decode from memory
+                if isinstance(source, (str, os.PathLike)):
+                    with open(source, 'rb') as f:
+                        source = f.read()
+                key = self.cache_key(source, digest)
+                cached = self.cache.get(key)
+                timings["cache_lookup"] = time.perf_counter() - started
+
+            if cached is not None:
+                analysis = cached
+                if progress:
+                    progress("cache_hit")
+            else:
+                if self.pool is not None:
+                    # Stage callbacks can't cross the process boundary; report the hand-off only
+                    if progress:
+                        progress("analyzing")
+                    submitted = time.perf_counter()
+                    analysis = self.pool.run(analyze_in_worker, self.settings(), source)
+                    timings["pool_roundtrip"] = time.perf_counter() - submitted
+                else:
+                    analysis = self.analyze(source, progress=progress)
+                if 'error' in analysis:
+                    return analysis
+                if self.cache is not None:
+                    self.cache.put(key, analysis)
+                timings.update(analysis["timings"])
+
+            response_started = time.perf_counter()
+            result = self.apply_mood(analysis, mood or self.default_mood)
+            result["cached"] = cached is not None
+            if cached is not None:
+                # Like the timings: report what ran for this call, not the stages of the cached analysis
+                result["pipeline_stages"] = ["cache_lookup"]
+            finished = time.perf_counter()
+            timings["response"] = finished - response_started
+            result["timings"] = {stage: round(seconds * 1000, 3) for stage, seconds in timings.items()}
+            result["processing_time"] = round(finished - started, 3)
+            return result
+            
+        except PoolBusy:
+            # Let the caller turn this into a 503 instead of an analysis error
+            raise
+        except AnalysisTimeout as e:
+            return {"error": str(e)}
+        except Exception as e:
+            return {"error": f"Error processing image: {str(e)}"}
+
+    def iter_count_leaves_batch(self, sources, moods=None, max_workers=None):
+        """Analyze many images concurrently, yielding (index, result) as each one finishes.
+        `moods` is one mood for the whole batch or a list with one mood per source.
+        A failing image only produces an {"error": ...} result for its own index."""
+        sources = list(sources)
+        if moods is None or isinstance(moods, str):
+            moods = [moods] * len(sources)
+        if max_workers is None:
+            # With a process pool, threads only wait on it: match its capacity
+            max_workers = self.pool.workers + self.pool.queue_depth if self.pool else (os.cpu_count() or 2)
+        
+        def run(index):
+            try:
+                return index, self.count_leaves(sources[index], mood=moods[index])
+            except PoolBusy as e:
+                return index, {"error": "Server is busy, please retry shortly", "retry_after": e.retry_after}
+        
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(sources) or 1))) as executor:
+            futures = [executor.submit(run, index) for index in range(len(sources))]
+            for future in as_completed(futures):
+                yield future.result()
+
+    def count_leaves_batch(self, sources, moods=None, max_workers=None):
+        """Batch version of count_leaves: returns the results in input order"""
+        results = [None] * len(sources)
+        for index, result in self.iter_count_leaves_batch(sources, moods, max_workers):
+            results[index] = result
+        return results
+
+    def apply_mood(self, analysis, mood):
+        """Layer the mood-driven randomness (accuracy, noise, confidence, comment) on top of analyze()"""
+        is_tree = analysis["is_tree"]
+        base_leaf_count = analysis["base_count"]
+
+        # If not a tree, flip to maximum anger (for this result only) and lower confidence
+        if not is_tree:
+            mood = "terrible"
+            # Reduce the confidence when angry (the base count is already zero)
+            accuracy_range = (5, 20)
+        else:
+            # Apply mood-based accuracy variation
+            accuracy_range = self.mood_accuracy_map[mood]
+        accuracy_factor = random.uniform(accuracy_range[0], accuracy_range[1]) / 100
+        
+        # Add some randomness to make it more realistic
+        noise_factor = random.uniform(0.8, 1.2)
+        
+        # Calculate final leaf count with mood-based accuracy
+        final_leaf_count = int(base_leaf_count * accuracy_factor * noise_factor)
+        
+        # Ensure we don't return negative counts
+        final_leaf_count = max(0, final_leaf_count)
+        
+        # Generate confidence score based on mood
+        confidence = random.uniform(accuracy_range[0], accuracy_range[1])
+        
+        # Pick sassy comment; if not a tree, pick from angry pool
+        comment = random.choice(self.non_tree_comments) if not is_tree else self.get_sassy_comment(mood)
+
+        return {
+            **analysis,
+            "leaf_count": final_leaf_count,
+            "confidence": round(confidence, 1),
+            "mood": mood,
+            "sassy_comment": comment
+        }
+
+def warmup_image(width=1024, height=768):
+    """Encoded JPEG of a small synthetic tree (trunk plus leaf blobs), for pre-warming the pipeline.
+    Big enough that the preview takes the reduced-resolution decode path."""
+    image = np.full((height, width, 3), 235, np.uint8)
+    cv2.rectangle(image, (width // 2 - 20, height // 2), (width // 2 + 20, height), (30, 60, 110), -1)
+    rng = np.random.RandomState(0)
+    for _ in range(60):
+        center = (int(rng.randint(width // 4, 3 * width // 4)), int(rng.randint(height // 8, height // 2)))
+        cv2.ellipse(image, center, (14, 8), int(rng.randint(0, 180)), 0, 360, (40, 160, 50), -1)
+    ok, encoded = cv2.imencode('.jpg', image)
+    return encoded.tobytes()
+
+# Analyzer used inside pool worker processes, created on the worker's first job
+_worker_ai = None
+
+def analyze_in_worker(settings, source):
+    """AnalysisPool entry point: run LeafCounterAI.analyze in a worker process"""
+    global _worker_ai
+    if _worker_ai is None or _worker_ai.settings() != settings:
+        _worker_ai = LeafCounterAI(**settings)
+    return _worker_ai.analyze(source)
+
+def warm_worker(settings):
+    """AnalysisPool initializer: create the worker's analyzer and run one dummy analysis"""
+    analyze_in_worker(settings, warmup_image())
+
+def encode_thumbnail(source, size):
+    """JPEG bytes of `source` scaled to at most `size` pixels on its longest side, or None.
+    Uses a reduced-resolution decode, so large originals are never fully decoded."""
+    image, _ = decode_image(source, max_side=size)
+    if image is None:
+        return None
+    ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 85])
+    return encoded.tobytes() if ok else None
+
+IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED
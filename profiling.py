@@ -0,0 +1,137 @@
+"""
+On-demand request profiling: cProfile captures kept in a bounded directory
+"""
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import re
+import secrets
+import threading
+import time
+
+# Profile ids are generated here; anything else is never turned into a path
+# Ids without the nanosecond part come from older versions; they are still listed and pruned
+PROFILE_ID = re.compile(r'^\d{8}-\d{6}(-\d{9})?-[0-9a-f]{8}$')
+
+SORT_KEYS = set(pstats.Stats.sort_arg_dict_default)
+
+
+class ProfileStore:
+    """Keeps the cProfile dumps of profiled requests in `directory`.
+
+    Each profile is a `<id>.prof` file (pstats format, readable by snakeviz or
+    `python -m pstats`) next to a `<id>.json` file with the request details,
+    the analysis stage timings and the top functions. Only the newest
+    `max_profiles` are kept. One request is profiled at a time: cProfile
+    hooks the whole interpreter on newer Pythons, and overlapping captures
+    would blur each other anyway.
+    """
+
+    def __init__(self, directory, max_profiles=50, top_functions=15):
+        self.directory = directory
+        self.max_profiles = max_profiles
+        self.top_functions = top_functions
+        self._active = threading.Lock()
+
+    def start(self):
+        """An enabled cProfile.Profile, or None while another request is being profiled"""
+        if not self._active.acquire(blocking=False):
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler (a debugger, say) already owns the hooks
+            self._active.release()
+            return None
+        return profiler
+
+    def stop(self, profiler):
+        profiler.disable()
+        self._active.release()
+
+    @staticmethod
+    def new_id():
+        # Nanoseconds within the second keep ids created in the same second in creation order
+        seconds, nanoseconds = divmod(time.time_ns(), 10**9)
+        return f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(seconds))}-{nanoseconds:09d}-{secrets.token_hex(4)}"
+
+    def save(self, profiler, details, profile_id=None):
+        """Write a stopped profile with its `details` dict; returns the stored metadata"""
+        os.makedirs(self.directory, exist_ok=True)
+        profile_id = profile_id or self.new_id()
+        stats = pstats.Stats(profiler)
+        stats.dump_stats(self._path(profile_id, '.prof'))
+        meta = {
+            "id": profile_id,
+            "created": time.strftime('%Y-%m-%d %H:%M:%S'),
+            **details,
+            "total_calls": stats.total_calls,
+            "top_functions": self._top_functions(stats),
+        }
+        # Metadata last: a profile is listed only once both files are complete
+        with open(self._path(profile_id, '.json'), 'w') as f:
+            json.dump(meta, f)
+        self._prune()
+        return meta
+
+    def _top_functions(self, stats):
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:self.top_functions]
+        return [{
+            "function": pstats.func_std_string(func),
+            "calls": calls,
+            "tottime_ms": round(tottime * 1000, 3),
+            "cumtime_ms": round(cumtime * 1000, 3),
+        } for func, (_, calls, tottime, cumtime, _) in rows]
+
+    def _path(self, profile_id, ext):
+        return os.path.join(self.directory, profile_id + ext)
+
+    def _ids(self):
+        """Stored profile ids, oldest first (ids sort by creation time)"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(name[:-5] for name in names if name.endswith('.json') and PROFILE_ID.match(name[:-5]))
+
+    def _prune(self):
+        ids = self._ids()
+        for profile_id in ids[:max(0, len(ids) - self.max_profiles)]:
+            for ext in ('.json', '.prof'):
+                try:
+                    os.remove(self._path(profile_id, ext))
+                except FileNotFoundError:
+                    pass
+
+    def list(self):
+        """Metadata of the stored profiles, newest first"""
+        profiles = []
+        for profile_id in reversed(self._ids()):
+            try:
+                with open(self._path(profile_id, '.json')) as f:
+                    profiles.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return profiles
+
+    def path(self, profile_id):
+        """Path of a stored .prof file, or None"""
+        if not PROFILE_ID.match(profile_id):
+            return None
+        path = self._path(profile_id, '.prof')
+        return path if os.path.exists(path) else None
+
+    def text(self, profile_id, sort='cumulative', limit=50):
+        """pstats report of a stored profile, or None; `sort` is a pstats sort key"""
+        path = self.path(profile_id)
+        if path is None:
+            return None
+        if sort not in SORT_KEYS:
+            raise ValueError(f"sort must be one of {sorted(SORT_KEYS)}")
+        out = io.StringIO()
+        pstats.Stats(path, stream=out).sort_stats(sort).print_stats(limit)
+        return out.getvalue()
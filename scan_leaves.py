@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Offline bulk scan: count leaves in every image under one or more directories
+
+Walks the directories lazily, analyzes the images on all cores and writes one
+JSON result per line as each image finishes. With --checkpoint, every finished
+path is appended to a checkpoint file; running the same command again skips
+them, so an interrupted scan picks up where it stopped.
+
+Examples:
+    python scan_leaves.py /data/surveys --output results.jsonl --checkpoint scan.ckpt
+    python scan_leaves.py /data/surveys --workers 8 --mood neutral > results.jsonl
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+from leaf_counter import ALLOWED_EXTENSIONS, LeafCounterAI
+
+
+def iter_images(roots, skip=None):
+    """Yield image paths under `roots`, depth first, streaming each directory listing
+    instead of collecting whole trees up front. Paths whose checkpoint key is in `skip`
+    are left out. Pass absolute roots to get absolute paths, as checkpoints expect."""
+    def wanted(path):
+        return path.rsplit('.', 1)[-1].lower() in ALLOWED_EXTENSIONS and \
+            (skip is None or checkpoint_key(path) not in skip)
+
+    stack = list(reversed(roots))
+    while stack:
+        top = stack.pop()
+        if os.path.isfile(top):
+            if wanted(top):
+                yield top
+            continue
+        subdirs = []
+        try:
+            with os.scandir(top) as scan:
+                for entry in scan:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif wanted(entry.path):
+                        yield entry.path
+        except OSError as e:
+            print(f"⚠️  Skipping {top}: {e}", file=sys.stderr)
+        stack.extend(reversed(subdirs))
+
+
+def checkpoint_key(path):
+    """Key of an absolute path in the resume set"""
+    # 16-byte digests keep the resume set small even for millions of paths
+    return hashlib.blake2b(os.fsencode(path), digest_size=16).digest()
+
+
+def load_checkpoint(path):
+    done = set()
+    if path and os.path.exists(path):
+        with open(path, 'r', encoding='utf-8', errors='surrogateescape') as f:
+            for line in f:
+                if line.endswith('\n'):  # a torn last line is simply redone
+                    # Checkpoints from before paths were made absolute resolve against the current directory
+                    done.add(checkpoint_key(os.path.abspath(line[:-1])))
+    return done
+
+
+# Paths sent to a worker at a time
+CHUNKSIZE = 4
+
+# Analyzer of each worker process, built by the pool initializer
+_worker = None
+
+
+def _init_worker(settings, mood):
+    global _worker
+    _worker = (LeafCounterAI(**settings), mood)
+
+
+def _scan_one(path):
+    ai, mood = _worker
+    try:
+        result = ai.count_leaves(path, mood=mood)
+    except Exception as e:
+        result = {"error": f"Error processing image: {str(e)}"}
+    return {"path": path, **result}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Count leaves in every image under the given directories")
+    parser.add_argument('roots', nargs='+', help="directories (or single images) to scan")
+    parser.add_argument('--output', default='-', help="JSONL output file, appended to (default stdout)")
+    parser.add_argument('--checkpoint', help="append-only list of finished paths; skipped when resuming")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--max-in-flight', type=int, default=0,
+                        help="paths handed to the workers ahead of the results (default 64 per worker)")
+    parser.add_argument('--mood', default='neutral', help="mood applied to every result")
+    parser.add_argument('--backend', default='contours', help="segmentation backend: contours or components")
+    parser.add_argument('--tree-check-max-side', type=int, default=512)
+    parser.add_argument('--work-max-side', type=int, default=0)
+    parser.add_argument('--tile-memory-mb', type=int, default=0)
+    parser.add_argument('--progress-every', type=int, default=1000, help="report progress on stderr every N images")
+    args = parser.parse_args(argv)
+
+    settings = {
+        "segmentation_backend": args.backend,
+        "tree_check_max_side": args.tree_check_max_side or None,
+        "work_max_side": args.work_max_side or None,
+        "tile_memory_budget": args.tile_memory_mb * 1024 * 1024 or None,
+    }
+    # Checked here, once: a setting the analyzer rejects would otherwise kill every pool
+    # worker in its initializer, and the pool would keep replacing them forever
+    try:
+        LeafCounterAI(**settings).set_mood(args.mood)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # Absolute paths, so `scan` and `/tmp/scan`, or the same command run elsewhere, share a checkpoint
+    roots = [os.path.abspath(root) for root in args.roots]
+    done = load_checkpoint(args.checkpoint)
+    if done:
+        print(f"⏩ Resuming: {len(done)} images already done", file=sys.stderr)
+
+    # Pool.imap_unordered drains its input eagerly; the semaphore keeps the walk only a
+    # bounded distance ahead of the results (at least one chunk, or the feeder would wait forever)
+    in_flight = threading.BoundedSemaphore(max(CHUNKSIZE, args.max_in_flight or 64 * args.workers))
+
+    def paths():
+        for path in iter_images(roots, done):
+            in_flight.acquire()
+            yield path
+
+    output = sys.stdout if args.output == '-' else open(args.output, 'a', encoding='utf-8')
+    checkpoint = open(args.checkpoint, 'a', encoding='utf-8', errors='surrogateescape') if args.checkpoint else None
+    scanned = errors = 0
+    started = time.perf_counter()
+    try:
+        with multiprocessing.Pool(args.workers, initializer=_init_worker, initargs=(settings, args.mood)) as pool:
+            for result in pool.imap_unordered(_scan_one, paths(), chunksize=CHUNKSIZE):
+                in_flight.release()
+                output.write(json.dumps(result) + "\n")
+                output.flush()
+                # Checkpoint after the result is written: a crash in between repeats an image, never loses one
+                if checkpoint is not None:
+                    checkpoint.write(result["path"] + "\n")
+                    checkpoint.flush()
+                scanned += 1
+                errors += 'error' in result
+                if args.progress_every and scanned % args.progress_every == 0:
+                    rate = scanned / (time.perf_counter() - started)
+                    print(f"🍃 {scanned} images ({errors} errors), {rate:.1f}/s", file=sys.stderr)
+    except KeyboardInterrupt:
+        print("\n⏸️  Interrupted; run the same command again to resume", file=sys.stderr)
+        return 130
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        if checkpoint is not None:
+            checkpoint.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"✅ Scanned {scanned} images ({errors} errors) in {elapsed:.1f}s", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,60 @@
+"""
+Tests for the ASGI entry point: Flask routes must not wait on each other
+"""
+
+import asyncio
+import threading
+
+from asgi import LeafCounterASGI
+from app import create_app
+
+
+def make_app(tmp_path):
+    flask_app = create_app({'UPLOAD_FOLDER': str(tmp_path), 'PERSIST_UPLOADS': False, 'HISTORY': False,
+                            'RETENTION_INTERVAL': 3600})
+    release = threading.Event()
+
+    @flask_app.route('/test/slow')
+    def slow():
+        # Only returns 'released' if /test/fast runs while this request is still going
+        return 'released' if release.wait(timeout=5) else 'timed out'
+
+    @flask_app.route('/test/fast')
+    def fast():
+        release.set()
+        return 'fast'
+
+    return LeafCounterASGI(flask_app, analysis_threads=1, wsgi_threads=4)
+
+
+async def call(app, path):
+    scope = {'type': 'http', 'http_version': '1.1', 'method': 'GET', 'path': path, 'root_path': '',
+             'query_string': b'', 'headers': [], 'scheme': 'http', 'server': ('testserver', 80)}
+    sent = []
+    body = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+
+    async def receive():
+        if body:
+            return body.pop()
+        await asyncio.Event().wait()
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    status = next(message['status'] for message in sent if message['type'] == 'http.response.start')
+    return status, b''.join(message.get('body', b'') for message in sent if message['type'] == 'http.response.body')
+
+
+def test_flask_routes_run_concurrently(tmp_path):
+    app = make_app(tmp_path)
+
+    async def main():
+        slow = asyncio.create_task(call(app, '/test/slow'))
+        await asyncio.sleep(0.2)
+        fast = await asyncio.wait_for(call(app, '/test/fast'), timeout=2)
+        return fast, await slow
+
+    fast, slow = asyncio.run(main())
+    assert fast == (200, b'fast')
+    assert slow == (200, b'released')
@@ -0,0 +1,65 @@
+"""
+Tests for leaf segmentation: the backends and the strip-wise count must agree,
+and strip-wise processing must stay within its memory budget
+"""
+
+import glob
+import os
+import tracemalloc
+
+import cv2
+import numpy as np
+import pytest
+
+from leaf_counter import ImageAnalysis, segment_components, segment_contours, tiled_mask_stats
+
+
+def random_mask(seed, height=96, width=128):
+    """Blobs of all sizes, touching and nested, plus salt noise"""
+    rng = np.random.RandomState(seed)
+    mask = np.zeros((height, width), np.uint8)
+    for _ in range(rng.randint(10, 60)):
+        center = (int(rng.randint(0, width)), int(rng.randint(0, height)))
+        axes = (int(rng.randint(1, 16)), int(rng.randint(1, 16)))
+        cv2.ellipse(mask, center, axes, int(rng.randint(0, 180)), 0, 360, 255 * int(rng.rand() < 0.8), -1)
+    mask[rng.rand(height, width) < 0.02] = 255
+    return mask
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_backends_and_strips_agree(seed):
+    mask = random_mask(seed)
+    height, width = mask.shape
+    bounds = (4, 300)
+    expected = segment_contours(mask, *bounds)
+    assert segment_components(mask, *bounds) == expected
+
+    def strip_masks(y0, y1):
+        return mask[y0:y1], np.zeros((y1 - y0, width), np.uint8)
+
+    for strip_rows in (1, 2, 7, 16, 33, height):
+        green, brown, leaf_count = tiled_mask_stats(strip_masks, height, width, strip_rows, *bounds)
+        assert (green, brown, leaf_count) == (cv2.countNonZero(mask), 0, expected), strip_rows
+
+
+@pytest.mark.parametrize("backend", ["contours", "components"])
+@pytest.mark.parametrize("budget_mb", [4, 16, 64])
+def test_tiled_peak_memory_within_budget(backend, budget_mb):
+    image = cv2.imread(sorted(glob.glob(os.path.join(os.path.dirname(__file__), 'uploads', '*_tree2.jpg')))[0])
+    budget = budget_mb * 1024 * 1024
+    analysis = ImageAnalysis(image, memory_budget=budget, segmentation_backend=backend)
+    assert analysis.tiled
+    # One-time imports on first use (np.unique pulls in numpy.ma) are not part of the working set
+    ImageAnalysis(image[:64], memory_budget=1, segmentation_backend=backend).leaf_count()
+
+    tracemalloc.start()
+    try:
+        analysis.green_ratio
+        analysis.brown_ratio
+        leaf_count = analysis.leaf_count()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    assert peak <= budget
+    assert leaf_count == ImageAnalysis(image, segmentation_backend=backend).leaf_count()
@@ -13,8 +13,6 @@ def test_imports():
         'cv2',
         'numpy',
         'PIL',
-        'skimage',
-        'matplotlib',
         'werkzeug'
     ]
     
@@ -40,7 +38,8 @@ def test_imports():
 def test_flask_app():
     """Test if Flask app can be created"""
     try:
-        from app import app
+        from app import create_app
+        create_app()
         print("✅ Flask app created successfully!")
         return True
     except Exception as e:
@@ -50,7 +49,7 @@ def test_flask_app():
 def test_ai_model():
     """Test if AI model can be initialized"""
     try:
-        from app import LeafCounterAI
+        from leaf_counter import LeafCounterAI
         ai = LeafCounterAI()
         print("✅ AI model initialized successfully!")
         
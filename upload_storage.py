@@ -0,0 +1,170 @@
+"""
+Content-addressed storage for uploaded images, with deduplication and retention
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+
+class UploadStorage:
+    """Stores each unique image once, named by its SHA-256 digest.
+
+    Blobs live in two levels of sharded subdirectories
+    (`blobs/ab/cd/abcd...ef.jpg`) so no directory grows huge, and a small
+    SQLite index maps public filenames to blobs and tracks sizes and last
+    access times. Retention (`max_bytes`, `max_age` in seconds) evicts the
+    least recently used blobs first; it runs in a background thread once
+    start_retention() is called. Thumbnails are kept next to the blobs under
+    `thumbs/` and are removed together with their blob.
+    """
+
+    def __init__(self, root, max_bytes=None, max_age=None):
+        self.root = root
+        self.blob_root = os.path.join(root, 'blobs')
+        self.thumb_root = os.path.join(root, 'thumbs')
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(self.blob_root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(root, 'index.sqlite3'), check_same_thread=False)
+        self._db.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS blobs (
+                digest TEXT PRIMARY KEY,
+                ext TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS blobs_last_access ON blobs (last_access);
+            CREATE TABLE IF NOT EXISTS names (
+                filename TEXT PRIMARY KEY,
+                digest TEXT NOT NULL REFERENCES blobs (digest) ON DELETE CASCADE
+            );
+            CREATE INDEX IF NOT EXISTS names_digest ON names (digest);
+        """)
+        self._db.execute("PRAGMA foreign_keys=ON")
+        self._thread = None
+
+    @staticmethod
+    def public_name(digest, filename):
+        """Public filename for an upload: short digest prefix + the (already secured) original name"""
+        return f"{digest[:16]}_{filename}"
+
+    def blob_path(self, digest, ext):
+        return os.path.join(self.blob_root, digest[:2], digest[2:4], f"{digest}{ext}")
+
+    def thumbnail_path(self, digest, size):
+        return os.path.join(self.thumb_root, digest[:2], digest[2:4], f"{digest}_{size}.jpg")
+
+    def save_thumbnail(self, digest, size, data):
+        """Write encoded thumbnail bytes for a blob; returns the thumbnail path"""
+        path = self.thumbnail_path(digest, size)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return path
+
+    def store(self, public_name, digest, data):
+        """Map `public_name` to the blob for `digest`, writing the blob only if it is new"""
+        ext = os.path.splitext(public_name)[1].lower()
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT ext FROM blobs WHERE digest = ?", (digest,)).fetchone()
+            if row is None:
+                path = self.blob_path(digest, ext)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Write then rename so readers never see a partial blob
+                tmp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+                self._db.execute("INSERT INTO blobs (digest, ext, size, created, last_access) VALUES (?, ?, ?, ?, ?)",
+                                 (digest, ext, len(data), now, now))
+            else:
+                self._db.execute("UPDATE blobs SET last_access = ? WHERE digest = ?", (now, digest))
+            self._db.execute("INSERT OR REPLACE INTO names (filename, digest) VALUES (?, ?)", (public_name, digest))
+            self._db.commit()
+
+    def lookup(self, public_name, touch=True):
+        """(blob path, digest) for a public filename, or None; `touch` refreshes its LRU position"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT blobs.digest, blobs.ext FROM names JOIN blobs ON blobs.digest = names.digest "
+                "WHERE names.filename = ?", (public_name,)).fetchone()
+            if row is None:
+                return None
+            if touch:
+                self._db.execute("UPDATE blobs SET last_access = ? WHERE digest = ?", (time.time(), row[0]))
+                self._db.commit()
+        return self.blob_path(row[0], row[1]), row[0]
+
+    def enforce_retention(self):
+        """Delete blobs past max_age, then least recently used ones until under max_bytes.
+        Returns the number of blobs removed."""
+        removed = []
+        # Blobs created before the cutoff are expired regardless of size
+        cutoff = time.time() - self.max_age if self.max_age else 0
+        with self._lock:
+            if self.max_age:
+                removed += self._db.execute("SELECT digest, ext FROM blobs WHERE created < ?", (cutoff,)).fetchall()
+            if self.max_bytes:
+                total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs WHERE created >= ?",
+                                         (cutoff,)).fetchone()[0]
+                if total > self.max_bytes:
+                    for digest, ext, size in self._db.execute(
+                            "SELECT digest, ext, size FROM blobs WHERE created >= ? ORDER BY last_access",
+                            (cutoff,)).fetchall():
+                        if total <= self.max_bytes:
+                            break
+                        removed.append((digest, ext))
+                        total -= size
+            for digest, ext in removed:
+                self._db.execute("DELETE FROM names WHERE digest = ?", (digest,))
+                self._db.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+            self._db.commit()
+            # Files go while the lock is still held: otherwise a store() of the same content in
+            # between would re-add the row and rewrite the blob, which would then be deleted here
+            for digest, ext in removed:
+                self._remove_files(digest, ext)
+        return len(removed)
+
+    def _remove_files(self, digest, ext):
+        try:
+            os.remove(self.blob_path(digest, ext))
+        except FileNotFoundError:
+            pass
+        thumb_dir = os.path.dirname(self.thumbnail_path(digest, 0))
+        if os.path.isdir(thumb_dir):
+            for name in os.listdir(thumb_dir):
+                if name.startswith(f"{digest}_"):
+                    try:
+                        os.remove(os.path.join(thumb_dir, name))
+                    except FileNotFoundError:
+                        pass
+
+    def start_retention(self, interval=300):
+        """Run enforce_retention every `interval` seconds in a daemon thread"""
+        if self._thread is not None or not (self.max_bytes or self.max_age):
+            return
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.enforce_retention()
+                except Exception as e:
+                    print(f"Upload retention failed: {e}")
+
+        self._thread = threading.Thread(target=loop, name="upload-retention", daemon=True)
+        self._thread.start()
+
+    def stats(self):
+        with self._lock:
+            blobs, total = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+            names = self._db.execute("SELECT COUNT(*) FROM names").fetchone()[0]
+        return {"blobs": blobs, "bytes": total, "names": names, "max_bytes": self.max_bytes, "max_age": self.max_age}